@@ -0,0 +1,375 @@
+"""
+Benchmarks tree construction, split search, prediction and the moving average backtest on seeded synthetic data
+
+@author: Artem Naida
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Both tree packages have modules named functions and decision_tree, so every suite runs in its own process
+SUITES = {
+    "forest": os.path.join(ROOT, "Decision Trees and Random Forest"),
+    "boost": os.path.join(ROOT, "Decision Trees and Gradient Boost"),
+    "trader": os.path.join(ROOT, "Moving Average Trading Algorithm"),
+}
+RESULTS_FORMAT = 1
+
+
+def make_features(rows, numeric, categorical, levels, rng):
+    """
+    Makes a data frame of random features: numeric columns x0, x1, ... drawn from a standard normal and
+    categorical columns c0, c1, ... drawn uniformly from levels named l0, l1, ...
+    Returns the frame and a signal that depends on every feature, for building a label or target from.
+
+    :param rows: int
+    :param numeric: int
+    :param categorical: int
+    :param levels: int
+    :param rng: numpy Generator
+    :return: pandas data frame, numpy array
+    """
+    frame = pd.DataFrame(index=range(rows))
+    signal = np.zeros(rows)
+    for j in range(numeric):
+        frame["x" + str(j)] = rng.normal(size=rows)
+        signal += rng.normal() * np.sin(frame["x" + str(j)].to_numpy() * (1 + j % 3))
+    for j in range(categorical):
+        codes = rng.integers(0, levels, rows)
+        frame["c" + str(j)] = np.array(["l" + str(level) for level in range(levels)], dtype=object)[codes]
+        signal += rng.normal(size=levels)[codes]
+    return frame, signal
+
+
+def make_classification(rows, numeric=4, categorical=2, classes=3, levels=8, seed=0):
+    """
+    Makes a seeded classification data frame with a label column named "lbl" holding classes k0, k1, ... that
+    split the signal of make_features into equal shares, with some noise.
+
+    :param rows: int
+    :param numeric: int
+    :param categorical: int
+    :param classes: int
+    :param levels: int
+    :param seed: int
+    :return: pandas data frame
+    """
+    rng = np.random.default_rng(seed)
+    frame, signal = make_features(rows, numeric, categorical, levels, rng)
+    signal += rng.normal(scale=0.3 * (signal.std() or 1), size=rows)
+    cuts = np.quantile(signal, np.linspace(0, 1, classes + 1)[1:-1])
+    frame["lbl"] = np.array(["k" + str(k) for k in range(classes)], dtype=object)[np.searchsorted(cuts, signal)]
+    return frame
+
+
+def make_regression(rows, numeric=4, categorical=2, levels=8, seed=0):
+    """
+    Makes a seeded regression data frame with a target column named "tg": the signal of make_features plus noise.
+
+    :param rows: int
+    :param numeric: int
+    :param categorical: int
+    :param levels: int
+    :param seed: int
+    :return: pandas data frame
+    """
+    rng = np.random.default_rng(seed)
+    frame, signal = make_features(rows, numeric, categorical, levels, rng)
+    frame["tg"] = signal + rng.normal(scale=0.3 * (signal.std() or 1), size=rows)
+    return frame
+
+
+def make_prices(days, start=1000.0, seed=0):
+    """
+    Makes a seeded series of daily closing prices as a geometric random walk.
+
+    :param days: int
+    :param start: float
+    :param seed: int
+    :return: list
+    """
+    returns = np.random.default_rng(seed).normal(0.0002, 0.015, days)
+    return (start * np.exp(np.cumsum(returns))).round(2).tolist()
+
+
+def same_forest(first, second):
+    """
+    Checks whether two random forests have the same trees, node for node, and the same out-of-bag score.
+
+    :param first: RandomForest
+    :param second: RandomForest
+    :return: boolean
+    """
+    if first.oob_score_ != second.oob_score_ or len(first.trees) != len(second.trees):
+        return False
+    for one, other in zip(first.compile(), second.compile()):
+        for name in ("feature", "threshold", "left", "right", "value", "groups"):
+            if not np.array_equal(getattr(one, name), getattr(other, name)):
+                return False
+    return True
+
+
+def forest_cases(rows):
+    """
+    Benchmarks for the random forest package: split search, tree and forest construction and prediction.
+    Every case is a name, its parameters and the callable to time. Raises a RuntimeError if a forest grown in
+    two processes differs from the same forest grown in one.
+
+    :param rows: int
+    :return: list
+    """
+    import functions as fc
+    import decision_tree as dt
+    import random_forest as rf
+
+    numeric = make_classification(rows, numeric=6, categorical=0)
+    categorical = make_classification(rows, numeric=0, categorical=6, levels=16)
+    mixed = make_classification(rows)
+    points = [mixed.iloc[[i]] for i in range(100)]
+    forest = rf.RandomForest(mixed, 11, random_state=0)
+    if not same_forest(forest, rf.RandomForest(mixed, 11, n_jobs=2, random_state=0)):
+        raise RuntimeError("A random forest grown in parallel differs from the one grown serially")
+    return [
+        ("numeric_splitter", {"rows": rows}, lambda: fc.numeric_splitter(numeric, "x0")),
+        ("decision_tree_numeric", {"rows": rows, "numeric": 6, "classes": 3},
+         lambda: dt.DecisionTree(numeric, max_levels=8)),
+        ("decision_tree_categorical", {"rows": rows, "categorical": 6, "levels": 16, "classes": 3},
+         lambda: dt.DecisionTree(categorical, max_levels=8)),
+        ("decision_tree_binned", {"rows": rows, "numeric": 6, "classes": 3},
+         lambda: dt.DecisionTree(numeric, max_levels=8, binned=True)),
+        ("random_forest", {"rows": rows, "numeric": 4, "categorical": 2, "trees": 11},
+         lambda: rf.RandomForest(mixed, 11, random_state=0)),
+        ("random_forest_parallel", {"rows": rows, "numeric": 4, "categorical": 2, "trees": 11, "jobs": 2},
+         lambda: rf.RandomForest(mixed, 11, n_jobs=2, random_state=0)),
+        ("random_forest_classify_point", {"rows": len(points), "trees": 11},
+         lambda: [forest.classify_point(point) for point in points]),
+        ("random_forest_classify_frame", {"rows": rows, "trees": 11}, lambda: forest.classify_frame(mixed)),
+    ]
+
+
+def boost_cases(rows):
+    """
+    Benchmarks for the gradient boost package: split search, tree and model construction and prediction.
+    Every case is a name, its parameters and the callable to time.
+
+    :param rows: int
+    :return: list
+    """
+    import functions as fc
+    import decision_tree as dt
+    import gradient_boost as gb
+
+    numeric = make_regression(rows, numeric=6, categorical=0)
+    categorical = make_regression(rows, numeric=0, categorical=6, levels=16)
+    mixed = make_regression(rows)
+    points = [mixed.iloc[[i]] for i in range(100)]
+    model = gb.GradientBoost(mixed, 0.1, 20, 8)
+    return [
+        ("split_continuous", {"rows": rows}, lambda: fc.split_continuous(numeric, "x0")),
+        ("decision_tree_reg_numeric", {"rows": rows, "numeric": 6, "leaves": 32},
+         lambda: dt.DecisionTreeReg(numeric, max_leaves=32)),
+        ("decision_tree_reg_categorical", {"rows": rows, "categorical": 6, "levels": 16, "leaves": 32},
+         lambda: dt.DecisionTreeReg(categorical, max_leaves=32)),
+        ("decision_tree_reg_binned", {"rows": rows, "numeric": 6, "leaves": 32},
+         lambda: dt.DecisionTreeReg(numeric, max_leaves=32, binned=True)),
+        ("gradient_boost", {"rows": rows, "numeric": 4, "categorical": 2, "trees": 20, "leaves": 8},
+         lambda: gb.GradientBoost(mixed, 0.1, 20, 8)),
+        ("gradient_boost_predict_point", {"rows": len(points), "trees": 20},
+         lambda: [model.predict_point(point) for point in points]),
+        ("gradient_boost_predict_frame", {"rows": rows, "trees": 20}, lambda: model.predict_frame(mixed)),
+    ]
+
+
+def trader_cases(rows):
+    """
+    Benchmarks for the moving average trading algorithm: a backtest over a synthetic price series with each engine,
+    one over a panel of 100 series at once, and a random sweep of 2000 parameter sets.
+
+    :param rows: int
+    :return: list
+    """
+    spec = importlib.util.spec_from_file_location("moving_average_trader", "Moving Average Trader.py")
+    trader = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(trader)
+    days = max(rows // 2, 250)
+    prices = make_prices(days)
+    panel = np.column_stack([make_prices(days, seed=seed) for seed in range(100)])
+    return [
+        ("moving_average_backtest", {"days": days, "short_time": 5},
+         lambda: trader.MovingAverageExperiment(5, 100, 100, 10000, 0, prices).run_experiment()),
+        ("moving_average_vectorized", {"days": days, "short_time": 5},
+         lambda: trader.MovingAverageExperiment(5, 100, 100, 10000, 0, prices).run_vectorized()),
+        ("moving_average_panel", {"days": days, "tickers": 100, "short_time": 5},
+         lambda: trader.panel_backtest(panel, 5, 100, 100)),
+        ("moving_average_sweep", {"days": days, "parameter_sets": 2000},
+         lambda: trader.random_sweep(prices, 2000, seed=0)),
+    ]
+
+
+def measure(name, suite, params, run, repeat):
+    """
+    Times a callable repeat times, then runs it once more under tracemalloc for its peak memory, which is
+    measured separately because tracing slows everything down.
+
+    :param name: str
+    :param suite: str
+    :param params: dict
+    :param run: callable
+    :param repeat: int
+    :return: dict
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {"name": name, "suite": suite, "params": params, "repeat": repeat, "median_s": statistics.median(times),
+            "min_s": min(times), "peak_memory_mb": peak / 2 ** 20}
+
+
+def run_worker(suite, rows, repeat, only, output):
+    """
+    Runs the benchmarks of one suite inside its package directory and writes their results as JSON to output.
+
+    :param suite: str
+    :param rows: int
+    :param repeat: int
+    :param only: list, names of the cases to run, or None for all
+    :param output: str
+    """
+    cases = {"forest": forest_cases, "boost": boost_cases, "trader": trader_cases}[suite](rows)
+    results = []
+    for name, params, run in cases:
+        if only and name not in only:
+            continue
+        results.append(measure(name, suite, params, run, repeat))
+        print("  " + name + ": " + format(results[-1]["median_s"], ".4f") + " s, "
+              + format(results[-1]["peak_memory_mb"], ".1f") + " MB", file=sys.stderr)
+    with open(output, "w") as file:
+        json.dump(results, file)
+
+
+def run_benchmarks(suites, rows, repeat, only=None):
+    """
+    Runs every suite in its own Python process, started in its package directory, and gathers the results with
+    the details of the machine and libraries they were measured on.
+
+    :param suites: list
+    :param rows: int
+    :param repeat: int
+    :param only: list
+    :return: dict
+    """
+    results = []
+    for suite in suites:
+        print(suite + ":", file=sys.stderr)
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, suite + ".json")
+            command = [sys.executable, os.path.abspath(__file__), "worker", suite, "--rows", str(rows),
+                       "--repeat", str(repeat), "--output", output] + (["--only"] + only if only else [])
+            environment = dict(os.environ, PYTHONPATH=SUITES[suite])
+            subprocess.run(command, cwd=SUITES[suite], env=environment, check=True, stdout=subprocess.DEVNULL)
+            with open(output) as file:
+                results.extend(json.load(file))
+    return {"format": RESULTS_FORMAT, "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__,
+            "machine": platform.platform(), "rows": rows, "results": results}
+
+
+def compare(current, baseline, tolerance=0.2, memory_tolerance=0.2, min_seconds=0.002):
+    """
+    Compares two benchmark runs case by case. A case regresses if its median time grows by more than tolerance,
+    or its peak memory by more than memory_tolerance, as a share of the baseline. Time differences smaller than
+    min_seconds are put down to noise.
+    Returns a data frame with one row per case and a column flagging the regressions.
+
+    :param current: dict
+    :param baseline: dict
+    :param tolerance: float
+    :param memory_tolerance: float
+    :param min_seconds: float
+    :return: pandas data frame
+    """
+    before = {result["name"]: result for result in baseline["results"]}
+    rows = []
+    for result in current["results"]:
+        old = before.get(result["name"])
+        if old is None:
+            continue
+        time_ratio = result["median_s"] / old["median_s"] if old["median_s"] > 0 else float("inf")
+        memory_ratio = result["peak_memory_mb"] / old["peak_memory_mb"] if old["peak_memory_mb"] > 0 else 1.0
+        rows.append({"name": result["name"], "baseline_s": old["median_s"], "current_s": result["median_s"],
+                     "time_ratio": time_ratio, "baseline_mb": old["peak_memory_mb"],
+                     "current_mb": result["peak_memory_mb"], "memory_ratio": memory_ratio,
+                     "regression": (time_ratio > 1 + tolerance and result["median_s"] - old["median_s"] > min_seconds)
+                     or memory_ratio > 1 + memory_tolerance})
+    return pd.DataFrame(rows, columns=["name", "baseline_s", "current_s", "time_ratio", "baseline_mb",
+                                       "current_mb", "memory_ratio", "regression"])
+
+
+def main(arguments):
+    if arguments.command == "worker":
+        run_worker(arguments.suite, arguments.rows, arguments.repeat, arguments.only, arguments.output)
+    elif arguments.command == "run":
+        results = run_benchmarks(arguments.suites, arguments.rows, arguments.repeat, arguments.only)
+        with open(arguments.output, "w") as file:
+            json.dump(results, file, indent=2)
+        print("Wrote " + str(len(results["results"])) + " results to " + arguments.output)
+    else:
+        with open(arguments.current) as file:
+            current = json.load(file)
+        with open(arguments.baseline) as file:
+            baseline = json.load(file)
+        if current.get("rows") != baseline.get("rows"):
+            print("Warning: the runs used different numbers of rows", file=sys.stderr)
+        table = compare(current, baseline, arguments.tolerance, arguments.memory_tolerance, arguments.min_seconds)
+        print(table.to_string(index=False, float_format=lambda value: format(value, ".4g")))
+        regressions = table["name"][table["regression"]].tolist()
+        if regressions:
+            print("Regressions: " + ", ".join(regressions))
+            sys.exit(1)
+        print("No regressions")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the tree packages and the moving average backtest")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run the benchmarks and save their results as JSON")
+    run_parser.add_argument("--output", default="benchmark_results.json")
+    run_parser.add_argument("--suites", nargs="+", choices=sorted(SUITES), default=["forest", "boost", "trader"])
+    run_parser.add_argument("--rows", type=int, default=5000, help="rows of synthetic data per case")
+    run_parser.add_argument("--repeat", type=int, default=3, help="timed runs per case, the median is kept")
+    run_parser.add_argument("--only", nargs="+", default=None, help="names of the cases to run")
+    compare_parser = commands.add_parser("compare", help="flag regressions against a saved baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("--tolerance", type=float, default=0.2, help="allowed growth of the median time")
+    compare_parser.add_argument("--memory-tolerance", type=float, default=0.2, help="allowed growth of peak memory")
+    compare_parser.add_argument("--min-seconds", type=float, default=0.002, help="time differences treated as noise")
+    worker_parser = commands.add_parser("worker", help=argparse.SUPPRESS)
+    worker_parser.add_argument("suite", choices=sorted(SUITES))
+    worker_parser.add_argument("--rows", type=int, default=5000)
+    worker_parser.add_argument("--repeat", type=int, default=3)
+    worker_parser.add_argument("--only", nargs="+", default=None)
+    worker_parser.add_argument("--output", required=True)
+    main(parser.parse_args())
@@ -0,0 +1,556 @@
+"""
+Implements the pieces of the tree packages that do not depend on which package uses them. The random forest and
+gradient boost packages both put this folder on the module search path and import from here, so each piece has
+one copy
+
+@author: Artem Naida
+"""
+
+import json
+import struct
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+# Files written by save_compiled start with this magic number and the version of their layout
+MODEL_MAGIC = b"DTMODEL\x00"
+MODEL_FORMAT = 1
+# Every array in a model file starts at a multiple of this many bytes, so it can be memory-mapped in place
+MODEL_ALIGNMENT = 64
+
+
+def quantile_edges(values, max_bins):
+    """
+    Chooses up to max_bins - 1 split candidates for a continuous feature from its quantiles. Every candidate is
+    a value that occurs in the data, so splits chosen between bins map back to real feature values.
+
+    :param values: numpy array
+    :param max_bins: int
+    :return: numpy array
+    """
+    distinct = np.unique(values)
+    if len(distinct) <= max_bins:
+        return distinct[:-1]
+    quantiles = np.quantile(values, np.linspace(0, 1, max_bins + 1)[1:-1], method="lower")
+    edges = np.unique(quantiles)
+    return edges[edges < distinct[-1]]
+
+
+def bin_codes(values, edges):
+    """
+    Quantizes a continuous feature into small integer bin codes. Bin b holds the values above edges[b - 1] and at
+    or below edges[b], so a point is at or below edges[b] exactly when its code is at most b.
+
+    :param values: numpy array
+    :param edges: numpy array
+    :return: numpy array
+    """
+    dtype = np.uint8 if len(edges) < 256 else np.uint16 if len(edges) < 65536 else np.int64
+    return np.searchsorted(edges, values, side="left").astype(dtype)
+
+
+class QuantileSketch:
+    """
+    A summary of a stream of numbers that answers quantile queries in bounded memory. It keeps sorted distinct
+    values with the number of points at each, and whenever there are more than capacity of them, merges runs of
+    neighbours into their largest value. The number of points at or below every kept value stays exact, and every
+    kept value occurs in the data.
+    """
+
+    def __init__(self, capacity=8192):
+        """
+        Creates an empty quantile sketch that keeps at most capacity values.
+
+        :param capacity: int
+        """
+        self.capacity = capacity
+        self.values = np.empty(0)
+        self.counts = np.empty(0, dtype=np.int64)
+        self.exact = True
+
+    def update(self, values):
+        """
+        Adds a batch of numbers to the sketch.
+
+        :param values: numpy array
+        """
+        distinct, counts = np.unique(values, return_counts=True)
+        self.values, inverse = np.unique(np.concatenate((self.values, distinct)), return_inverse=True)
+        self.counts = np.bincount(inverse, weights=np.concatenate((self.counts, counts)),
+                                  minlength=len(self.values)).astype(np.int64)
+        if len(self.values) > self.capacity:
+            # Group the values by the rank of their first point and keep the largest value of every group
+            cumulative = np.cumsum(self.counts)
+            group = (cumulative - self.counts) * self.capacity // cumulative[-1]
+            last = np.flatnonzero(np.append(group[1:] != group[:-1], True))
+            self.values = self.values[last]
+            self.counts = np.diff(cumulative[last], prepend=0)
+            self.exact = False
+
+    def edges(self, max_bins):
+        """
+        Chooses up to max_bins - 1 split candidates from the sketch, as quantile_edges does for data in memory.
+        While the sketch has not had to merge any values, the candidates are exactly those of quantile_edges.
+
+        :param max_bins: int
+        :return: numpy array
+        """
+        if self.exact and len(self.values) <= max_bins:
+            return self.values[:-1]
+        cumulative = np.cumsum(self.counts)
+        positions = np.floor(np.linspace(0, 1, max_bins + 1)[1:-1] * (cumulative[-1] - 1))
+        edges = np.unique(self.values[np.searchsorted(cumulative, positions, side="right")])
+        return edges[edges < self.values[-1]]
+
+
+def read_chunks(path, chunksize=100000):
+    """
+    Reads a CSV or Parquet file as a series of pandas data frames of at most chunksize rows each. Reading Parquet
+    files needs pyarrow.
+
+    :param path: str
+    :param chunksize: int
+    :return: generator
+    """
+    if str(path).endswith((".parquet", ".pq")):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, chunksize=chunksize)
+
+
+def candidate_counts(data, rows, columns, bins=None, partition=False):
+    """
+    Counts, for each of the given feature columns, the candidate splits that a split search weighs on the given
+    rows of an encoded data matrix: one between each pair of neighbouring distinct values (or occupied bins) of a
+    numeric feature, and one per level present for a categorical feature, or one between each pair of
+    neighbouring levels in sorted order if partition is True.
+
+    :param data: DataMatrix
+    :param rows: numpy array
+    :param columns: list
+    :param bins: dict
+    :param partition: boolean
+    :return: dict
+    """
+    counts = {}
+    for j in columns:
+        if data.types[j] == "categorical":
+            present = len(np.unique(data.columns[j][rows]))
+            counts[data.features[j]] = present - 1 if partition else present
+        else:
+            values = bins[j][1][rows] if bins and j in bins else data.columns[j][rows]
+            counts[data.features[j]] = max(len(np.unique(values)) - 1, 0)
+    return counts
+
+
+class BuildStats:
+    """
+    Instrumentation for building trees. Pass one to a tree or model as stats and it keeps one record for every
+    node made (its depth, rows, wall time, candidate splits weighed per feature and the gain of its best split)
+    and one summary for every tree (its nodes, leaves, depth, wall time, candidate splits and, if memory is True,
+    the peak memory traced by tracemalloc while it was built). Tracing memory slows the build down, so the times
+    are best read with memory set to False. Without a stats object, trees skip all of this.
+    """
+
+    def __init__(self, memory=True):
+        """
+        :param memory: boolean, whether to trace the peak memory of every tree
+        """
+        self.memory = memory
+        self.nodes = []
+        self.trees = []
+        self.pending = []
+        self.started = None
+        self.tracing = False
+
+    def __str__(self):
+        return "Build statistics for " + str(len(self.trees)) + " trees and " + str(len(self.nodes)) + " nodes"
+
+    def start_tree(self):
+        """
+        Starts the clock, and the memory trace if asked for, for a tree about to be built.
+        """
+        if self.memory:
+            self.tracing = not tracemalloc.is_tracing()
+            if self.tracing:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        self.pending = []
+        self.started = time.perf_counter()
+
+    def record_node(self, node, depth, seconds, gain, candidates):
+        """
+        Records a node of the tree being built.
+
+        :param node: the node
+        :param depth: int
+        :param seconds: float, the wall time taken to make the node and search for its split
+        :param gain: float, the gain of the node's best split
+        :param candidates: dict, the number of candidate splits weighed for each feature
+        """
+        record = {"tree": len(self.trees), "depth": depth, "rows": node.n, "seconds": seconds,
+                  "candidates": sum(candidates.values()), "feature": node.decision[1], "gain": gain,
+                  "candidates_per_feature": candidates}
+        self.nodes.append(record)
+        self.pending.append((record, node))
+
+    def end_tree(self, tree):
+        """
+        Finishes the summary of a tree once it is built. Nodes are marked as split or not only now, since a tree
+        can turn a node into a leaf after making it.
+
+        :param tree: the tree
+        """
+        seconds = time.perf_counter() - self.started
+        peak = None
+        if self.memory:
+            peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            if self.tracing:
+                tracemalloc.stop()
+        for record, node in self.pending:
+            record["split"] = node.left is not None
+        records = [record for record, _ in self.pending]
+        self.pending = []
+        self.trees.append({"tree": len(self.trees), "nodes": len(records),
+                           "leaves": sum(not record["split"] for record in records),
+                           "depth": max((record["depth"] for record in records), default=0),
+                           "seconds": seconds, "node_seconds": sum(record["seconds"] for record in records),
+                           "candidates": sum(record["candidates"] for record in records), "peak_memory_mb": peak})
+
+    def annotate(self, **values):
+        """
+        Adds values to the summary of the last tree built, such as a model's loss after it.
+        """
+        self.trees[-1].update(values)
+
+    def merge(self, other):
+        """
+        Adds the records of another stats object, for example one filled in a worker process, numbering its
+        trees after the ones already here.
+
+        :param other: BuildStats
+        """
+        offset = len(self.trees)
+        self.nodes.extend(dict(record, tree=record["tree"] + offset) for record in other.nodes)
+        self.trees.extend(dict(summary, tree=summary["tree"] + offset) for summary in other.trees)
+
+    def node_frame(self):
+        """
+        Exports the node records as a flat pandas data frame with one row per node, and a column
+        candidates_<feature> for every feature, which is empty at nodes that did not weigh that feature.
+
+        :return: pandas data frame
+        """
+        frame = pd.DataFrame([{key: value for key, value in record.items() if key != "candidates_per_feature"}
+                              for record in self.nodes])
+        per_feature = pd.DataFrame([record["candidates_per_feature"] for record in self.nodes], index=frame.index)
+        return pd.concat([frame, per_feature.add_prefix("candidates_")], axis=1)
+
+    def tree_frame(self):
+        """
+        Exports the tree summaries as a pandas data frame with one row per tree.
+
+        :return: pandas data frame
+        """
+        return pd.DataFrame(self.trees)
+
+
+def json_values(values):
+    """
+    Turns an array of levels, classes or predictions into a list of plain Python values that can be written as JSON.
+
+    :param values: numpy array
+    :return: list
+    """
+    return [value.item() if isinstance(value, np.generic) else value for value in values]
+
+
+class CompiledTree:
+    """
+    A trained decision tree flattened into parallel numpy arrays, one entry per node. Leaf nodes have feature -1.
+    Each package's decision_tree.py subclasses it with the type of its leaf values and how they become predictions.
+    """
+
+    # The type of the value array
+    value_type = float
+
+    def __init__(self, features, categorical, levels, feature, threshold, left, right, value, groups):
+        """
+        Creates a compiled tree. Node i splits on features[feature[i]] and sends a point to right[i] if it is above
+        threshold[i], or for a categorical feature if its level is in groups[threshold[i]], and to left[i]
+        otherwise. Groups hold codes into levels[feature[i]]. The value of node i is value[i].
+
+        :param features: list
+        :param categorical: list
+        :param levels: list
+        :param feature: list
+        :param threshold: list
+        :param left: list
+        :param right: list
+        :param value: list
+        :param groups: list
+        """
+        self.features = list(features)
+        self.categorical = np.array(categorical, dtype=bool)
+        self.levels = [None if group is None else np.array(group, dtype=object) for group in levels]
+        self.feature = np.array(feature, dtype=np.int64)
+        self.threshold = np.array(threshold, dtype=float)
+        self.left = np.array(left, dtype=np.int64)
+        self.right = np.array(right, dtype=np.int64)
+        self.value = np.array(value, dtype=self.value_type)
+        self.groups = group_table(groups, self.levels)
+
+    @classmethod
+    def from_arrays(cls, features, categorical, levels, feature, threshold, left, right, value, groups):
+        """
+        Rebuilds a compiled tree around arrays that are already in its layout, for example views of a memory-mapped
+        model file. Groups is the boolean table of group members. No data is copied.
+
+        :param features: list
+        :param categorical: numpy array
+        :param levels: list
+        :param feature: numpy array
+        :param threshold: numpy array
+        :param left: numpy array
+        :param right: numpy array
+        :param value: numpy array
+        :param groups: numpy array
+        :return: CompiledTree
+        """
+        tree = cls.__new__(cls)
+        tree.features = list(features)
+        tree.categorical = categorical
+        tree.levels = list(levels)
+        tree.feature = feature
+        tree.threshold = threshold
+        tree.left = left
+        tree.right = right
+        tree.value = value
+        tree.groups = groups
+        return tree
+
+    def encode(self, frame):
+        """
+        Encodes the features this tree splits on from a pandas data frame into a numeric matrix. Categorical values
+        become codes into the levels the tree splits on, and levels the tree never splits on become -1.
+
+        :param frame: pandas data frame
+        :return: numpy array
+        """
+        matrix = np.empty((len(frame.index), len(self.features)))
+        for k, feature in enumerate(self.features):
+            if self.categorical[k]:
+                matrix[:, k] = pd.Categorical(frame[feature], categories=self.levels[k]).codes
+            else:
+                matrix[:, k] = frame[feature].to_numpy(dtype=float)
+        return matrix
+
+    def encode_data(self, data, rows=None):
+        """
+        Encodes the features this tree splits on from the given rows (or all rows) of a DataMatrix into a numeric
+        matrix, as encode does for a data frame, without going back to a data frame.
+
+        :param data: DataMatrix
+        :param rows: numpy array
+        :return: numpy array
+        """
+        n = data.n if rows is None else len(rows)
+        matrix = np.empty((n, len(self.features)))
+        for k, feature in enumerate(self.features):
+            j = data.features.index(feature)
+            column = data.columns[j] if rows is None else data.columns[j][rows]
+            if self.categorical[k]:
+                lookup = pd.Index(self.levels[k]).get_indexer(data.levels[j])
+                matrix[:, k] = np.where(column >= 0, lookup[column], -1)
+            else:
+                matrix[:, k] = column
+        return matrix
+
+    def apply(self, matrix):
+        """
+        Pushes every row of an encoded matrix through the tree, one level at a time for all rows together.
+        Returns the index of the leaf that each row lands in.
+
+        :param matrix: numpy array
+        :return: numpy array
+        """
+        node = np.zeros(len(matrix), dtype=np.int64)
+        active = np.flatnonzero(self.feature[node] >= 0)
+        while len(active):
+            current = node[active]
+            feature = self.feature[current]
+            values = matrix[active, feature]
+            threshold = self.threshold[current]
+            go_right = values > threshold
+            categorical = np.flatnonzero(self.categorical[feature])
+            if len(categorical):
+                codes = values[categorical].astype(np.int64)
+                go_right[categorical] = self.groups[threshold[categorical].astype(np.int64), codes]
+            node[active] = np.where(go_right, self.right[current], self.left[current])
+            active = active[self.feature[node[active]] >= 0]
+        return node
+
+
+def group_table(groups, levels):
+    """
+    Turns the groups of a compiled tree, each a list of codes into the levels of the feature it splits on, into a
+    boolean table with one row per group and one column per level, plus a last column for unseen levels which never
+    match.
+
+    :param groups: list
+    :param levels: list
+    :return: numpy array
+    """
+    width = max([len(group) for group in levels if group is not None], default=0) + 1
+    table = np.zeros((len(groups), width), dtype=bool)
+    for g, codes in enumerate(groups):
+        table[g, list(codes)] = True
+    return table
+
+
+def merge_compiled(trees):
+    """
+    Remaps compiled trees onto one shared list of features and levels, so that they all read the same encoded
+    feature matrix. Each tree is rebuilt as its own class, around its own threshold, child and value arrays.
+
+    :param trees: list
+    :return: list
+    """
+    features, categorical, levels = [], [], []
+    for tree in trees:
+        for k, feature in enumerate(tree.features):
+            if feature not in features:
+                features.append(feature)
+                categorical.append(tree.categorical[k])
+                levels.append([] if tree.categorical[k] else None)
+            if tree.categorical[k]:
+                shared_levels = levels[features.index(feature)]
+                shared_levels.extend(level for level in tree.levels[k] if level not in shared_levels)
+
+    categorical = np.array(categorical, dtype=bool)
+    level_arrays = [None if group is None else np.array(group, dtype=object) for group in levels]
+    merged = []
+    for tree in trees:
+        feature_map = np.array([features.index(feature) for feature in tree.features] + [-1])
+        level_maps = [None if group is None else
+                      np.array([levels[feature_map[k]].index(level) for level in group], dtype=np.int64)
+                      for k, group in enumerate(tree.levels)]
+        groups = [None] * len(tree.groups)
+        for i in np.flatnonzero(tree.feature >= 0):
+            k = tree.feature[i]
+            if tree.categorical[k]:
+                g = int(tree.threshold[i])
+                groups[g] = level_maps[k][np.flatnonzero(tree.groups[g])]
+        merged.append(type(tree).from_arrays(features, categorical, level_arrays, feature_map[tree.feature],
+                                             tree.threshold, tree.left, tree.right, tree.value,
+                                             group_table(groups, level_arrays)))
+    return merged
+
+
+def save_compiled(path, model, trees, extra=None, classes=None):
+    """
+    Writes compiled trees that share one list of features and levels to a binary model file. The file holds a
+    magic number, the format version and the length of a JSON header, then the header, then every array of every
+    tree laid end to end. Each array starts on a 64 byte boundary, so the file can be memory-mapped and its arrays
+    used in place. The header names the model and holds the shared lists, any extra values, and the offset, type
+    and shape of every array. Trees whose values are indices into a shared list of classes store it too.
+
+    :param path: str
+    :param model: str
+    :param trees: list
+    :param extra: dict
+    :param classes: numpy array
+    """
+    first = trees[0]
+    arrays = {
+        "node_offsets": np.cumsum([0] + [len(tree.feature) for tree in trees]),
+        "group_offsets": np.cumsum([0] + [len(tree.groups) for tree in trees]),
+        "feature": np.concatenate([tree.feature for tree in trees]),
+        "threshold": np.concatenate([tree.threshold for tree in trees]),
+        "left": np.concatenate([tree.left for tree in trees]),
+        "right": np.concatenate([tree.right for tree in trees]),
+        "value": np.concatenate([tree.value for tree in trees]),
+        "groups": np.concatenate([tree.groups for tree in trees]),
+    }
+    header = {"model": model, "features": json_values(first.features),
+              "categorical": [bool(flag) for flag in first.categorical],
+              "levels": [None if group is None else json_values(group) for group in first.levels]}
+    if classes is not None:
+        header["classes"] = json_values(classes)
+    header.update({"extra": extra or {}, "arrays": {}})
+    offset = 0
+    for name, array in arrays.items():
+        header["arrays"][name] = [offset, array.dtype.str, list(array.shape)]
+        offset += -(-array.nbytes // MODEL_ALIGNMENT) * MODEL_ALIGNMENT
+    header_bytes = json.dumps(header).encode("utf-8")
+    start = -(-(len(MODEL_MAGIC) + 8 + len(header_bytes)) // MODEL_ALIGNMENT) * MODEL_ALIGNMENT
+    with open(path, "wb") as file:
+        file.write(MODEL_MAGIC + struct.pack("<II", MODEL_FORMAT, len(header_bytes)) + header_bytes)
+        for name, array in arrays.items():
+            file.write(bytes(start + header["arrays"][name][0] - file.tell()))
+            file.write(np.ascontiguousarray(array).tobytes())
+
+
+def read_model_header(path):
+    """
+    Reads the header of a model file written by save_compiled. Raises a ValueError if the file is not a model file
+    of this format.
+
+    Returns the header and the offset in the file at which its arrays start.
+
+    :param path: str
+    :return: dict, int
+    """
+    with open(path, "rb") as file:
+        magic = file.read(len(MODEL_MAGIC))
+        if magic != MODEL_MAGIC:
+            raise ValueError("Not a model file: " + str(path))
+        version, header_length = struct.unpack("<II", file.read(8))
+        if version != MODEL_FORMAT:
+            raise ValueError("Unsupported model format: " + str(version))
+        header = json.loads(file.read(header_length).decode("utf-8"))
+    return header, -(-(len(MODEL_MAGIC) + 8 + header_length) // MODEL_ALIGNMENT) * MODEL_ALIGNMENT
+
+
+def load_compiled(path, model, tree_class=CompiledTree):
+    """
+    Memory-maps a model file written by save_compiled and rebuilds its compiled trees as views of the file, so
+    nothing is read until it is used. The trees are made as tree_class, and given the file's classes if it has
+    any. Raises a ValueError if the file is not a model file of this format or holds a different kind of model.
+
+    Returns the file's header and the list of compiled trees.
+
+    :param path: str
+    :param model: str
+    :param tree_class: CompiledTree or a subclass
+    :return: dict, list
+    """
+    header, start = read_model_header(path)
+    if header["model"] != model:
+        raise ValueError("File holds a " + header["model"] + ", not a " + model)
+    # Plain array views of the mapping index much faster than numpy memmap objects and still share its pages
+    buffer = np.memmap(path, dtype=np.uint8, mode="r").view(np.ndarray)
+    arrays = {}
+    for name, (offset, dtype, shape) in header["arrays"].items():
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape)) * dtype.itemsize
+        arrays[name] = buffer[start + offset:start + offset + size].view(dtype).reshape(shape)
+
+    categorical = np.array(header["categorical"], dtype=bool)
+    levels = [None if group is None else np.array(group, dtype=object) for group in header["levels"]]
+    classes = np.array(header["classes"], dtype=object) if "classes" in header else None
+    node_offsets = arrays["node_offsets"]
+    group_offsets = arrays["group_offsets"]
+    trees = []
+    for t in range(len(node_offsets) - 1):
+        nodes = slice(node_offsets[t], node_offsets[t + 1])
+        trees.append(tree_class.from_arrays(header["features"], categorical, levels, arrays["feature"][nodes],
+                                            arrays["threshold"][nodes], arrays["left"][nodes],
+                                            arrays["right"][nodes], arrays["value"][nodes],
+                                            arrays["groups"][group_offsets[t]:group_offsets[t + 1]]))
+        if classes is not None:
+            trees[-1].classes = classes
+    return header, trees
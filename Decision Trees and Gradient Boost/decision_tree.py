@@ -5,38 +5,76 @@ Implements decision tree regression objects
 """
 
 import functions as fc
-
+import tree_common as tc
+from concurrent.futures import ThreadPoolExecutor
+from heapq import heappush, heappop
 
 class DecisionTreeRegNode:
     """
     A node in a decision tree for regression
     """
-    def __init__(self, data):
+    def __init__(self, data, rows, bins=None, executor=None, partition=False, search=True, considered=None):
         """
-        A node in a Decision Tree for Regression.
+        A node in a Decision Tree for Regression, built on the given rows of an encoded data matrix. The node only
+        keeps the row indices until the tree finalizes it, and keeps its size and mean target as plain values. If
+        bins from functions.bin_features are given, continuous features are split on their bin codes. If a thread
+        pool executor is given, features are scored concurrently. If partition is True, categorical features can be
+        split into any two groups of levels. If search is False, the node is made a leaf without looking for a
+        split. If a considered list is given, the indices of the feature columns weighed for the split are appended
+        to it.
+
+        :param data: DataMatrix
+        :param rows: numpy array
+        :param bins: dict
+        :param executor: concurrent.futures.Executor
+        :param partition: boolean
+        :param search: boolean
+        :param considered: list
         """
-        self.input_data = data
-        self.n = max(data.count())
+        self.rows = rows
+        self.n = len(rows)
         self.left, self.right = None, None
+        target = data.target[rows]
+        self.value = fc.np.mean(target) if self.n else fc.np.nan
 
         # If you pass trivial input data or fewer than 10 items, just create a leaf
-        if self.n < 10 or fc.np.var(data["tg"]) == 0:
+        if not search or self.n < 10 or fc.np.var(target) == 0:
             self.leaf = True
             self.decision = None, None, None
             self.variance_reduction = 0
         else:
-            result = fc.find_best_split(data)
+            result = fc.find_best_split(data, bins, rows, executor, partition, considered)
             if result[3] == 0:
                 self.leaf = True
                 self.decision = None, None, None
                 self.variance_reduction = 0
+            else:
+                best_feature_type = result[0]
+                best_feature = result[1]
+                split = result[2]
+                self.variance_reduction = result[3]
+                self.leaf = False
+                self.decision = best_feature_type, best_feature, split
 
-            best_feature_type = result[0]
-            best_feature = result[1]
-            split = result[2]
-            self.variance_reduction = result[3]
-            self.leaf = False
-            self.decision = best_feature_type, best_feature, split
+    @classmethod
+    def from_summary(cls, n, value):
+        """
+        Makes a leaf from the number of rows that reach it and their mean target, for trees grown without the rows
+        in memory.
+
+        :param n: int
+        :param value: float
+        :return: DecisionTreeRegNode
+        """
+        node = cls.__new__(cls)
+        node.rows = None
+        node.n = n
+        node.left, node.right = None, None
+        node.value = value
+        node.leaf = True
+        node.decision = None, None, None
+        node.variance_reduction = 0
+        return node
 
     def __str__(self):
         """
@@ -53,50 +91,42 @@ class DecisionTreeRegNode:
         return "A decision tree for regression node split on " + str(type_) + " feature type named " + \
                str(feature) + " split on " + str(split) + " with variance reduction " + str(variance_reduction)
 
-    def pass_right(self):
+    def pass_right(self, data):
         """
-        Takes a pandas data frame, passes the appropriate portion downstream to the right node.
+        Takes the encoded data matrix, passes the indices of this node's rows that go downstream to the right node.
 
-        :return: pandas data frame
+        :param data: DataMatrix
+        :return: numpy array
         """
         feature_type = self.decision[0]
         feature = self.decision[1]
         split = self.decision[2]
-        if feature_type == "continuous":
-            return self.input_data[self.input_data[feature] > split]
-        elif feature_type == "categorical":
-            return self.input_data[self.input_data[feature] == split]
-        elif not feature_type:
-            pass
-        else:
-            raise TypeError("Something went horribly wrong")
+        if not feature_type:
+            return None
+        return self.rows[data.pass_rows(self.rows, feature_type, feature, split)]
 
-    def pass_left(self):
+    def pass_left(self, data):
         """
-        Takes a pandas data frame, passes the appropriate portion downstream to the left node.
+        Takes the encoded data matrix, passes the indices of this node's rows that go downstream to the left node.
 
-        :return: pandas data frame
+        :param data: DataMatrix
+        :return: numpy array
         """
         feature_type = self.decision[0]
         feature = self.decision[1]
         split = self.decision[2]
-        if feature_type == "continuous":
-            return self.input_data[self.input_data[feature] <= split]
-        elif feature_type == "categorical":
-            return self.input_data[self.input_data[feature] != split]
-        elif not feature_type:
-            pass
-        else:
-            raise TypeError("Something went horribly wrong")
+        if not feature_type:
+            return None
+        return self.rows[~data.pass_rows(self.rows, feature_type, feature, split)]
 
     def predict(self):
         """
-        Produces the prediction of the target variable based on the current data.
-        Returns the prediction as the mean of the target variable within the input data.
+        Produces the prediction of the target variable based on the training data that reached this node.
+        Returns the prediction as the mean of the target variable within that data.
 
         :return: float
         """
-        return fc.np.mean(self.input_data["tg"])
+        return self.value
 
     def send_datapoint(self, datapoint):
         """
@@ -117,25 +147,110 @@ class DecisionTreeRegNode:
             if datapoint[feature].values[0] == split:
                 return 1
             return 0
+        elif feature_type == "partition":
+            if datapoint[feature].values[0] in split:
+                return 1
+            return 0
         elif not feature_type:
             pass
         else:
             raise TypeError("Something went horribly wrong")
 
 
+class CompiledTree(tc.CompiledTree):
+    """
+    A trained decision tree for regression flattened into parallel numpy arrays, one entry per node, as
+    tree_common.CompiledTree. The prediction at node i is value[i].
+    """
+
+    def predict(self, frame):
+        """
+        Predicts the target value for every row of a pandas data frame.
+
+        :param frame: pandas data frame
+        :return: numpy array
+        """
+        return self.value[self.apply(self.encode(frame))]
+
+    def predict_data(self, data):
+        """
+        Predicts the target value for every row of a DataMatrix.
+
+        :param data: DataMatrix
+        :return: numpy array
+        """
+        return self.value[self.apply(self.encode_data(data))]
+
+
 class DecisionTreeReg:
     """
     A decision tree for regression
     """
-    def __init__(self, input_data, max_leaves=None):
+    def __init__(self, input_data, max_leaves=None, binned=False, max_bins=255, n_jobs=None, fitted_values=None,
+                 category_partitions=False, growth="level", stats=None):
         """
-        Creates a new DecisionTreeReg as a nested list of DecisionTreeRegNode objects organized by level. If
-        random_subset is True, only chooses features from a random subset at each node.
+        Creates a new DecisionTreeReg as a nested list of DecisionTreeRegNode objects organized by level. If binned
+        is True, every continuous feature is quantized once into at most max_bins bins and each node splits on
+        per-bin sums of the target. Splits still land on real feature values.
+
+        The input data is encoded once into a functions.DataMatrix, or can be passed as one already, for example
+        one memory-mapped from disk by functions.DataMatrix.load. If n_jobs is more than 1, the features of large
+        nodes are scored concurrently in that many threads. If a fitted_values array is given, each training row's
+        prediction is written into it as soon as the row's leaf is known.
 
-        :param input_data: pandas data frame
+        Categorical features are split on one level against the rest. If category_partitions is True, they are
+        split into the best two groups of levels instead, found by sorting the levels by their mean target.
+
+        By default the tree grows one level at a time, splitting nodes in order until it has max_leaves leaves. If
+        growth is "best_first", it always splits the node with the largest variance reduction next instead.
+
+        If a functions.BuildStats is given as stats, every node made and the tree as a whole are recorded in it.
+
+        :param input_data: pandas data frame or DataMatrix
         :param max_leaves: int
+        :param binned: boolean
+        :param max_bins: int
+        :param n_jobs: int
+        :param fitted_values: numpy array
+        :param category_partitions: boolean
+        :param growth: str
+        :param stats: functions.BuildStats
         """
-        self.nodes = [[DecisionTreeRegNode(input_data)]]
+        if growth not in ("level", "best_first"):
+            raise ValueError("Growth must be 'level' or 'best_first'")
+        if not isinstance(input_data, fc.DataMatrix):
+            input_data = fc.DataMatrix(input_data)
+        bins = None
+        if binned:
+            bins = fc.bin_features(input_data, max_bins)
+        executor = ThreadPoolExecutor(max_workers=n_jobs) if n_jobs and n_jobs > 1 else None
+
+        # This function finalizes a leaf: it records the leaf's prediction for its rows, then lets go of them
+        def finalize(node_):
+            node_.leaf = True
+            if fitted_values is not None:
+                fitted_values[node_.rows] = node_.value
+            node_.rows = None
+
+        # This function makes a new node at the given depth, finalizing it straight away if it is a leaf. The node
+        # only looks for a split if search is True
+        def make_node(rows, depth, search=True):
+            if stats is None:
+                node_ = DecisionTreeRegNode(input_data, rows, bins, executor, category_partitions, search)
+            else:
+                considered = []
+                start = fc.time.perf_counter()
+                node_ = DecisionTreeRegNode(input_data, rows, bins, executor, category_partitions, search, considered)
+                stats.record_node(node_, depth, fc.time.perf_counter() - start, node_.variance_reduction,
+                                  fc.candidate_counts(input_data, rows, considered, bins, category_partitions))
+            if node_.leaf:
+                finalize(node_)
+            return node_
+
+        if stats is not None:
+            stats.start_tree()
+        self.nodes = [[make_node(fc.np.arange(input_data.n), 0)]]
+        self.compiled = None
         current_leaves = 1
         current_level = 0
 
@@ -151,31 +266,161 @@ class DecisionTreeReg:
                     leafs += 1
             return number_nodes == leafs
 
-        # Keep building a tree until all nodes on current level are leafs
-        while not all_leafs(self.nodes[current_level]):
-            next_level_list = []
-            for node in self.nodes[current_level]:
+        if growth == "level":
+            # Keep building a tree until all nodes on current level are leafs
+            while not all_leafs(self.nodes[current_level]):
+                next_level_list = []
+                for node in self.nodes[current_level]:
+                    if max_leaves and current_leaves == max_leaves:
+                        break
+                    # If the node is not a leaf, split it
+                    if not node.leaf:
+                        left_node = make_node(node.pass_left(input_data), current_level + 1)
+                        right_node = make_node(node.pass_right(input_data), current_level + 1)
+                        node.left = left_node
+                        node.right = right_node
+                        node.rows = None
+                        next_level_list.append(left_node)
+                        next_level_list.append(right_node)
+                        current_leaves += 1
+                self.nodes.append(next_level_list)
+                current_level += 1
+                # If we have reached max leaves, break
                 if max_leaves and current_leaves == max_leaves:
                     break
-                # If the node is not a leaf, split it
-                if not node.leaf:
-                    left_node = DecisionTreeRegNode(node.pass_left())
-                    right_node = DecisionTreeRegNode(node.pass_right())
-                    node.left = left_node
-                    node.right = right_node
-                    next_level_list.append(left_node)
-                    next_level_list.append(right_node)
-                    current_leaves += 1
-            self.nodes.append(next_level_list)
-            current_level += 1
-            # If we have reached max leaves, break
-            if max_leaves and current_leaves == max_leaves:
-                break
+        else:
+            # Keep splitting the candidate node whose split removes the most squared error until the leaf budget is
+            # spent. The variance reduction is per row, so it is weighted by the node's size
+            candidates = []
+            if not self.nodes[0][0].leaf:
+                root = self.nodes[0][0]
+                heappush(candidates, (-root.variance_reduction * root.n, 0, 0, root))
+            pushed = 1
+            while candidates and (not max_leaves or current_leaves < max_leaves):
+                node_level, node = heappop(candidates)[2:]
+                current_leaves += 1
+                # Only look for splits in the children if they could still be split themselves
+                search = not max_leaves or current_leaves < max_leaves
+                node.left = make_node(node.pass_left(input_data), node_level + 1, search)
+                node.right = make_node(node.pass_right(input_data), node_level + 1, search)
+                node.rows = None
+                if len(self.nodes) == node_level + 1:
+                    self.nodes.append([])
+                for child in (node.left, node.right):
+                    self.nodes[node_level + 1].append(child)
+                    if not child.leaf:
+                        heappush(candidates, (-child.variance_reduction * child.n, pushed, node_level + 1, child))
+                        pushed += 1
+
+        if executor is not None:
+            executor.shutdown()
 
         for level in self.nodes:
             for node in level:
-                if not node.left and not node.right:
+                if not node.left and not node.right and node.rows is not None:
+                    finalize(node)
+        if stats is not None:
+            stats.end_tree(self)
+
+    @classmethod
+    def from_chunks(cls, source, max_leaves=None, max_bins=255, chunksize=100000, category_partitions=False):
+        """
+        Grows a decision tree for regression on a CSV or Parquet file too large to load, reading it in chunks. The
+        file is scanned once for the bin edges of every continuous feature, then read once more for every level of
+        the tree, adding up per-bin target sums for the nodes still to be split. Memory use depends on the number
+        of bins and nodes, not on the number of rows. The tree grows level by level and splits as a binned
+        DecisionTreeReg does.
+
+        When a node splits, the count and target sums of its children come from its table for the chosen feature,
+        so a child that is bound to be a leaf is never counted again. Each node's sums are taken about its
+        parent's mean, which keeps them well conditioned.
+
+        :param source: str or functions.ChunkedData
+        :param max_leaves: int
+        :param max_bins: int
+        :param chunksize: int
+        :param category_partitions: boolean
+        :return: DecisionTreeReg
+        """
+        data = source if isinstance(source, fc.ChunkedData) else fc.ChunkedData(source, max_bins, chunksize)
+        tree = cls.__new__(cls)
+        tree.nodes = []
+        tree.compiled = None
+        parents = {}
+        current_leaves = 1
+        columns = range(len(data.features))
+
+        # Every node waiting to be made is [parent, side, level, summary, shift, histograms], where the summary
+        # is its count, target sum and target sum of squares about shift. The root's summary is only known once
+        # its histograms have been added up
+        waiting = [[None, None, 0, None, data.target_mean, {j: 0 for j in columns}]]
+        while waiting:
+            counting = {}
+            active = set()
+            for entry in waiting:
+                if entry[5]:
+                    counting[(None if entry[0] is None else id(entry[0]), entry[1])] = entry
+                    # Mark every node above the waiting node, so rows are only routed where they are counted
+                    node = entry[0]
+                    while node is not None and id(node) not in active:
+                        active.add(id(node))
+                        node = parents.get(id(node))
+            if counting:
+                for matrix, bins in data.chunks():
+                    rows = fc.np.arange(matrix.n)
+                    if not tree.nodes:
+                        root = counting[(None, None)]
+                        add_histograms(matrix, bins, root[4], root[5], rows)
+                    elif id(tree.nodes[0][0]) in active:
+                        route_chunk(matrix, bins, counting, active, tree.nodes[0][0], rows)
+
+            splitting = []
+            for parent, side, level, summary, shift, histograms in waiting:
+                if summary is None:
+                    summary = next(iter(histograms.values())).sum(axis=1)
+                count, total, squares = summary
+                node = DecisionTreeRegNode.from_summary(int(count), shift + total / count if count else fc.np.nan)
+                if parent is None:
+                    tree.nodes.append([node])
+                else:
+                    if len(tree.nodes) == level:
+                        tree.nodes.append([])
+                    tree.nodes[level].append(node)
+                    parents[id(node)] = parent
+                    if side:
+                        parent.right = node
+                    else:
+                        parent.left = node
+                # A node whose target only varies by rounding error counts as trivial, like one with fewer than 10
+                # rows
+                variance = squares / count - (total / count) ** 2 if count else 0
+                if not histograms or count < 10 or variance <= (1e-9 * node.value) ** 2:
+                    continue
+                result = fc.best_histogram_split(data, histograms, category_partitions)
+                if result[3] == 0:
+                    continue
+                node.leaf = False
+                node.decision = result[:3]
+                node.variance_reduction = result[3]
+                splitting.append((node, level, shift, histograms[data.features.index(result[1])]))
+
+            # Split the nodes in order until the leaf budget is spent, as DecisionTreeReg does
+            waiting = []
+            for node, level, shift, histogram in splitting:
+                if max_leaves and current_leaves == max_leaves:
                     node.leaf = True
+                    node.decision = None, None, None
+                    node.variance_reduction = 0
+                    continue
+                current_leaves += 1
+                search = not max_leaves or current_leaves < max_leaves
+                for child_side, (count, total, squares) in enumerate(fc.histogram_sides(data, histogram,
+                                                                                         *node.decision)):
+                    # Take the child's sums about its own mean, which its histograms will also be taken about
+                    summary = fc.np.array([count, 0.0, squares - total ** 2 / count])
+                    waiting.append([node, child_side, level + 1, summary, shift + total / count,
+                                    {j: 0 for j in columns} if search and count >= 10 else {}])
+        return tree
 
     def __str__(self):
         """
@@ -199,6 +444,85 @@ class DecisionTreeReg:
                 print(node)
             current_level += 1
 
+    def compile(self):
+        """
+        Compiles the trained tree into a CompiledTree of flat numpy arrays for fast batch prediction.
+        The result is cached, so the tree is only compiled once.
+
+        :return: CompiledTree
+        """
+        if self.compiled is not None:
+            return self.compiled
+        order = [self.nodes[0][0]]
+        features, categorical, levels, groups = [], [], [], []
+        feature, threshold, left, right, values = [], [], [], [], []
+        i = 0
+        while i < len(order):
+            node = order[i]
+            values.append(node.value)
+            if node.leaf:
+                feature.append(-1)
+                threshold.append(0)
+                left.append(-1)
+                right.append(-1)
+            else:
+                feature_type, name, split = node.decision
+                if name not in features:
+                    features.append(name)
+                    categorical.append(feature_type != "continuous")
+                    levels.append([] if categorical[-1] else None)
+                k = features.index(name)
+                if categorical[k]:
+                    group = [split] if feature_type == "categorical" else list(split)
+                    for level in group:
+                        if level not in levels[k]:
+                            levels[k].append(level)
+                    groups.append([levels[k].index(level) for level in group])
+                    split = len(groups) - 1
+                feature.append(k)
+                threshold.append(split)
+                left.append(len(order))
+                right.append(len(order) + 1)
+                order.append(node.left)
+                order.append(node.right)
+            i += 1
+        self.compiled = CompiledTree(features, categorical, levels, feature, threshold, left, right, values,
+                                     groups)
+        return self.compiled
+
+    def predict_frame(self, frame):
+        """
+        Predicts the target value for every row of a pandas data frame at once, using the compiled tree.
+
+        :param frame: pandas data frame
+        :return: numpy array
+        """
+        return self.compile().predict(frame)
+
+    def save(self, path):
+        """
+        Saves the compiled tree to a binary model file that DecisionTreeReg.load can memory-map. Only the tree's
+        structure is written, never its training data.
+
+        :param path: str
+        """
+        tc.save_compiled(path, "DecisionTreeReg", [self.compile()])
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a decision tree for regression saved by DecisionTreeReg.save. The file is memory-mapped, so loading
+        is almost instant and processes that load the same file share its pages. The loaded tree has no node
+        objects, so it predicts with its compiled arrays.
+
+        :param path: str
+        :return: DecisionTreeReg
+        """
+        tree = cls.__new__(cls)
+        tree.nodes = None
+        tree.compiled = load_compiled(path, "DecisionTreeReg")[1][0]
+        return tree
+
     def predict_point(self, datapoint):
         """
         Predicts the target value for a new data point, represented as a pandas data frame with a single row.
@@ -206,6 +530,8 @@ class DecisionTreeReg:
         :param datapoint: pandas data frame
         :return: float
         """
+        if self.nodes is None:
+            return self.predict_frame(datapoint)[0]
         current_node = self.nodes[0][0]
         while not current_node.leaf:
             if current_node.send_datapoint(datapoint):
@@ -223,3 +549,52 @@ class DecisionTreeReg:
         # display a graphic with the path that the point takes highlighted
         pass
 
+
+def add_histograms(matrix, bins, shift, histograms, rows):
+    """
+    Adds the target sums of the given rows of a chunk, taken about shift, to a node's histograms, a dictionary
+    from feature column index to the table made by functions.column_histogram.
+
+    :param matrix: DataMatrix
+    :param bins: dict
+    :param shift: float
+    :param histograms: dict
+    :param rows: numpy array
+    """
+    for j in histograms:
+        histograms[j] = histograms[j] + fc.column_histogram(matrix, j, rows, bins, shift)
+
+
+def route_chunk(matrix, bins, counting, active, node, rows):
+    """
+    Sends the given rows of a chunk down from a split node, adding them to the histograms of the nodes waiting to
+    be made below it. Waiting nodes are looked up in counting by parent and side. Rows are only sent into subtrees
+    whose nodes' ids are in active, the set of nodes with waiting nodes below them.
+
+    :param matrix: DataMatrix
+    :param bins: dict
+    :param counting: dict
+    :param active: set
+    :param node: DecisionTreeRegNode
+    :param rows: numpy array
+    """
+    go_right = matrix.pass_rows(rows, *node.decision)
+    for side, child, child_rows in ((0, node.left, rows[~go_right]), (1, node.right, rows[go_right])):
+        if child is None:
+            entry = counting.get((id(node), side))
+            if entry is not None:
+                add_histograms(matrix, bins, entry[4], entry[5], child_rows)
+        elif id(child) in active:
+            route_chunk(matrix, bins, counting, active, child, child_rows)
+
+
+def load_compiled(path, model):
+    """
+    Memory-maps a model file written by tree_common.save_compiled, with its trees rebuilt as CompiledTree objects
+    that predict.
+
+    :param path: str
+    :param model: str
+    :return: dict, list
+    """
+    return tc.load_compiled(path, model, CompiledTree)
@@ -4,15 +4,94 @@ Implements all the functions required for decision_tree and gradient_boost
 @author: Artem Naida
 """
 
+import json
+import os
+import sys
+import time
 import pandas as pd
 import numpy as np
 
+# The pieces both tree packages share are in tree_common.py, in the Decision Trees Common folder beside this one
+COMMON = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Decision Trees Common")
+if COMMON not in sys.path:
+    sys.path.append(COMMON)
+from tree_common import (BuildStats, QuantileSketch, bin_codes, candidate_counts, json_values, quantile_edges,
+                         read_chunks)
+
+# Nodes with fewer rows than this score their features one at a time even when a thread pool is given
+PARALLEL_MIN_ROWS = 10000
+
+# Version of the on-disk dataset format written by DataMatrix.save
+DATASET_FORMAT = 1
+
+
+def sweep_continuous(values, target):
+    """
+    Sorts a continuous feature once and sweeps every distinct value as a candidate split, keeping running sums and
+    sums of squares of the target on the left. Points at or below the split go left, points above it go right.
+    Returns the best splitting point and the associated variance reduction. When several splits give the same
+    variance reduction, the one whose value appears first in the input wins, as in an exhaustive search.
+
+    :param values: numpy array
+    :param target: numpy array
+    :return: numeric, float
+    """
+    n = len(values)
+    if n < 2:
+        return None, 0
+
+    order = np.argsort(values, kind="mergesort")
+    sorted_values = values[order]
+    # Centre the target so the sums of squares stay well conditioned
+    sorted_target = target[order] - np.mean(target)
+
+    # Each distinct value is a candidate; the largest one would leave the right side empty
+    distinct, first_seen, counts = np.unique(values, return_index=True, return_counts=True)
+    if len(distinct) < 2:
+        return None, 0
+    last_position = np.cumsum(counts)[:-1] - 1
+
+    left_sum = np.cumsum(sorted_target)[last_position]
+    left_squares = np.cumsum(sorted_target ** 2)[last_position]
+    left_n = last_position + 1
+    total_sum = np.sum(sorted_target)
+    total_squares = np.sum(sorted_target ** 2)
+
+    right_sum = total_sum - left_sum
+    right_squares = total_squares - left_squares
+    right_n = n - left_n
+
+    resulting_variance = (left_squares - left_sum ** 2 / left_n + right_squares - right_sum ** 2 / right_n) / n
+    variance_reduction = total_squares / n - total_sum ** 2 / n ** 2 - resulting_variance
+
+    maximum_variance_reduction = variance_reduction.max()
+    if not maximum_variance_reduction > 0:
+        return None, 0
+    # Reductions that only differ by rounding error count as ties
+    ties = np.flatnonzero(np.isclose(variance_reduction, maximum_variance_reduction, rtol=1e-12, atol=0))
+    best = ties[np.argmin(first_seen[ties])]
+    return sorted_values[last_position[best]].item(), variance_reduction[best].item()
+
 
 def split_continuous(data, feat):
     """
     Splits continuous data based on maximum variance reduction.
     Returns the best splitting point, along with the maximum variance reduction and the split type identifier.
 
+    :param data: pandas data frame
+    :param feat: str
+    :return: numeric, float, str
+    """
+    best_split, maximum_variance_reduction = sweep_continuous(data[feat].to_numpy(),
+                                                              data["tg"].to_numpy(dtype=float))
+    return best_split, maximum_variance_reduction, "continuous"
+
+
+def split_continuous_exhaustive(data, feat):
+    """
+    Reference version of split_continuous that tries every point as a split and filters the data for each one.
+    Runs in O(n^2) time, so only use it to check split_continuous on small inputs.
+
     :param data: pandas data frame
     :param feat: str
     :return: numeric, float, str
@@ -38,6 +117,149 @@ def split_continuous(data, feat):
     return best_split, maximum_variance_reduction, "continuous"
 
 
+def bin_features(data, max_bins=255):
+    """
+    Quantizes every continuous feature of an encoded data matrix once, for binned split finding.
+    Returns a dictionary from each continuous feature's column index to its split candidates and bin codes.
+
+    :param data: DataMatrix
+    :param max_bins: int
+    :return: dict
+    """
+    if max_bins < 2:
+        raise ValueError("Binned split finding needs at least 2 bins")
+    bins = {}
+    for j, feature_type in enumerate(data.types):
+        if feature_type == "continuous":
+            values = data.columns[j]
+            edges = quantile_edges(values, max_bins)
+            bins[j] = edges, bin_codes(values, edges)
+    return bins
+
+
+def binned_continuous(codes, edges, target):
+    """
+    Splits binned continuous data based on maximum variance reduction. Per-bin counts, sums and sums of squares of
+    the target are built in one pass and every split between bins is scored from their running totals.
+    Returns the best splitting point and the associated variance reduction.
+
+    :param codes: numpy array
+    :param edges: numpy array
+    :param target: numpy array
+    :return: numeric, float
+    """
+    number_bins = len(edges) + 1
+    centred = target - np.mean(target)
+    histogram = np.array([np.bincount(codes, minlength=number_bins),
+                          np.bincount(codes, weights=centred, minlength=number_bins),
+                          np.bincount(codes, weights=centred ** 2, minlength=number_bins)])
+    return continuous_histogram_split(histogram, edges)
+
+
+def continuous_histogram_split(histogram, edges):
+    """
+    Splits binned continuous data based on maximum variance reduction, from a (3 x bins) table holding the count,
+    the sum and the sum of squares of the target in every bin. The target may be shifted by any constant, but
+    shifting it close to its mean keeps the sums of squares well conditioned.
+    Returns the best splitting point and the associated variance reduction.
+
+    :param histogram: numpy array
+    :param edges: numpy array
+    :return: numeric, float
+    """
+    counts, sums, squares = histogram
+    n = counts.sum()
+    left_n = np.cumsum(counts)[:-1]
+    candidates = np.flatnonzero((left_n > 0) & (left_n < n))
+    if len(candidates) == 0:
+        return None, 0
+    left_n = left_n[candidates]
+    left_sum = np.cumsum(sums)[:-1][candidates]
+    left_squares = np.cumsum(squares)[:-1][candidates]
+    total_sum = sums.sum()
+    total_squares = squares.sum()
+
+    right_sum = total_sum - left_sum
+    right_squares = total_squares - left_squares
+    right_n = n - left_n
+
+    resulting_variance = (left_squares - left_sum ** 2 / left_n + right_squares - right_sum ** 2 / right_n) / n
+    variance_reduction = total_squares / n - total_sum ** 2 / n ** 2 - resulting_variance
+
+    best = np.argmax(variance_reduction)
+    if not variance_reduction[best] > 0:
+        return None, 0
+    return edges[candidates[best]].item(), variance_reduction[best].item()
+
+
+def sweep_categorical(codes, target, number_levels, partition=False):
+    """
+    Splits an integer-coded categorical feature based on maximum variance reduction. The count, sum and sum of
+    squares of the target for every level are built in one grouped pass, and every one-vs-rest split is scored
+    from those totals.
+
+    If partition is True, the levels are instead sorted by their mean target and every cut of that ordering is
+    scored, which finds the best split of the levels into any two groups. The levels above the cut go right.
+    Returns the chosen level code (or tuple of level codes for a partition) and the associated variance reduction.
+
+    :param codes: numpy array
+    :param target: numpy array
+    :param number_levels: int
+    :param partition: boolean
+    :return: int, float
+    :return: tuple, float
+    """
+    centred = target - np.mean(target)
+    histogram = np.array([np.bincount(codes, minlength=number_levels),
+                          np.bincount(codes, weights=centred, minlength=number_levels),
+                          np.bincount(codes, weights=centred ** 2, minlength=number_levels)])
+    return categorical_histogram_split(histogram, partition)
+
+
+def categorical_histogram_split(histogram, partition=False):
+    """
+    Splits an integer-coded categorical feature based on maximum variance reduction, from a (3 x levels) table
+    holding the count, the sum and the sum of squares of the (possibly shifted) target for every level. Splits
+    are one level against the rest, or any two groups of levels if partition is True, as in sweep_categorical.
+    Returns the chosen level code (or tuple of level codes for a partition) and the associated variance reduction.
+
+    :param histogram: numpy array
+    :param partition: boolean
+    :return: int, float
+    :return: tuple, float
+    """
+    counts, sums, squares = histogram
+    n = counts.sum()
+    total_sum = sums.sum()
+    total_squares = squares.sum()
+    present = np.flatnonzero(counts)
+    if len(present) < 2:
+        return None, 0
+
+    if partition:
+        present = present[np.argsort(sums[present] / counts[present], kind="mergesort")]
+        in_n = n - np.cumsum(counts[present])[:-1]
+        in_sum = total_sum - np.cumsum(sums[present])[:-1]
+        in_squares = total_squares - np.cumsum(squares[present])[:-1]
+    else:
+        in_n = counts[present]
+        in_sum = sums[present]
+        in_squares = squares[present]
+    out_n = n - in_n
+    out_sum = total_sum - in_sum
+    out_squares = total_squares - in_squares
+
+    resulting_variance = (in_squares - in_sum ** 2 / in_n + out_squares - out_sum ** 2 / out_n) / n
+    variance_reduction = total_squares / n - total_sum ** 2 / n ** 2 - resulting_variance
+
+    best = np.argmax(variance_reduction)
+    if not variance_reduction[best] > 0:
+        return None, 0
+    if partition:
+        return tuple(sorted(present[best + 1:].tolist())), variance_reduction[best].item()
+    return present[best].item(), variance_reduction[best].item()
+
+
 def split_categorical(data, feat):
     """
     Splits categorical data based on maximum variance reduction.
@@ -48,25 +270,10 @@ def split_categorical(data, feat):
     :param feat: str
     :return: str, float, str
     """
-    maximum_variance_reduction = 0
-    input_variance = np.var(data["tg"])
-    best_split = None
-
-    levels = set(data[feat].tolist())
-    for level in levels:
-        dfr1 = data[data[feat] == level]
-        dfr2 = data[data[feat] != level]
-
-        n = len(dfr1.index)
-        m = len(dfr2.index)
-
-        resulting_variance = (n / (n + m)) * np.var(dfr1["tg"]) + (m / (n + m)) * np.var(dfr2["tg"])
-        variance_reduction = input_variance - resulting_variance
-
-        if variance_reduction > maximum_variance_reduction:
-            best_split = level
-            maximum_variance_reduction = variance_reduction
-
+    codes, levels = pd.factorize(data[feat])
+    best_split, maximum_variance_reduction = sweep_categorical(codes, data["tg"].to_numpy(dtype=float), len(levels))
+    if best_split is not None:
+        best_split = levels[best_split]
     return best_split, maximum_variance_reduction, "categorical"
 
 
@@ -91,20 +298,221 @@ def splitter(data, feature):
         raise TypeError("Feature must be numeric or categorical")  # This shouldn't ever run
 
 
-def find_best_split(data):
+class DataMatrix:
+    """
+    A pandas data frame encoded once into one numpy array per column, so that trees can be built by passing row
+    indices around instead of copies of the data. It can be saved as a columnar dataset on disk and memory-mapped
+    back, so that it does not have to be parsed again.
+    """
+    def __init__(self, input_data, target="tg"):
+        """
+        Encodes a data frame whose target column is named target. Every other column is a feature, in any order.
+        Continuous features are stored as they are and categorical features as integer codes into their sorted
+        levels.
+
+        :param input_data: pandas data frame
+        :param target: str
+        """
+        self.target_column = target
+        self.path = None
+        self.features = [feature for feature in input_data.columns if feature != target]
+        self.n = len(input_data.index)
+        self.types = []
+        self.levels = []
+        self.columns = []
+        for feature in self.features:
+            column = input_data[feature]
+            if pd.api.types.is_string_dtype(column):
+                codes, levels = pd.factorize(column, sort=True)
+                self.types.append("categorical")
+                self.levels.append(np.asarray(levels, dtype=object))
+                self.columns.append(codes.astype(np.int64))
+            elif pd.api.types.is_numeric_dtype(column):
+                self.types.append("continuous")
+                self.levels.append(None)
+                self.columns.append(column.to_numpy(dtype=float))
+            else:
+                raise TypeError("Feature must be numeric or categorical")
+        self.target = input_data[target].to_numpy(dtype=float)
+
+    @classmethod
+    def from_arrays(cls, features, types, levels, columns, target, target_column="tg"):
+        """
+        Builds a data matrix around arrays that are already encoded, such as one chunk of a file read by
+        ChunkedData. No data is copied.
+
+        :param features: list
+        :param types: list
+        :param levels: list
+        :param columns: list
+        :param target: numpy array
+        :param target_column: str
+        :return: DataMatrix
+        """
+        data = cls.__new__(cls)
+        data.target_column = target_column
+        data.path = None
+        data.features = list(features)
+        data.types = list(types)
+        data.levels = list(levels)
+        data.columns = list(columns)
+        data.n = len(target)
+        data.target = target
+        return data
+
+    def save(self, path):
+        """
+        Saves the data matrix as a columnar dataset: a directory holding one .npy file per feature, one for the
+        target, and a metadata.json file with the features, their types and levels and the name of the target
+        column.
+
+        :param path: str
+        """
+        os.makedirs(path, exist_ok=True)
+        for j, column in enumerate(self.columns):
+            np.save(os.path.join(path, "feature_" + str(j) + ".npy"), column)
+        np.save(os.path.join(path, "target.npy"), self.target)
+        metadata = {"format": DATASET_FORMAT, "n": self.n, "target_column": self.target_column,
+                    "features": self.features, "types": self.types,
+                    "levels": [None if levels is None else json_values(levels) for levels in self.levels]}
+        with open(os.path.join(path, "metadata.json"), "w") as file:
+            json.dump(metadata, file, indent=1)
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """
+        Loads a columnar dataset saved by DataMatrix.save. The columns are memory-mapped rather than read, so
+        loading is almost instant and processes that load the same dataset share its pages.
+
+        :param path: str
+        :param mmap_mode: str
+        :return: DataMatrix
+        """
+        with open(os.path.join(path, "metadata.json")) as file:
+            metadata = json.load(file)
+        if metadata.get("format") != DATASET_FORMAT:
+            raise ValueError("Unsupported dataset format: " + str(metadata.get("format")))
+        columns = [np.load(os.path.join(path, "feature_" + str(j) + ".npy"), mmap_mode=mmap_mode)
+                   for j in range(len(metadata["features"]))]
+        levels = [None if group is None else np.array(group, dtype=object) for group in metadata["levels"]]
+        data = cls.from_arrays(metadata["features"], metadata["types"], levels, columns,
+                               np.load(os.path.join(path, "target.npy"), mmap_mode=mmap_mode),
+                               metadata["target_column"])
+        data.path = path
+        return data
+
+    def with_target(self, target):
+        """
+        Makes a data matrix that shares this one's features but has a different target, such as the residuals of a
+        gradient boost round. No feature data is copied.
+
+        :param target: numpy array
+        :return: DataMatrix
+        """
+        data = DataMatrix.__new__(DataMatrix)
+        data.__dict__.update(self.__dict__)
+        data.target = target
+        return data
+
+    def __str__(self):
+        """
+        Prints a short description of the data matrix.
+
+        :return: str
+        """
+        return "DataMatrix with " + str(self.n) + " rows and features " + str(self.features)
+
+    def pass_rows(self, rows, feature_type, feature, split):
+        """
+        Finds which of the given rows go right under a decision. Continuous points go right when they are above
+        the split, categorical points when they equal the split level, and partition points when they are one of
+        the split levels.
+
+        :param rows: numpy array
+        :param feature_type: str
+        :param feature: str
+        :param split: numeric or str
+        :return: numpy array
+        """
+        j = self.features.index(feature)
+        column = self.columns[j][rows]
+        if feature_type == "continuous":
+            return column > split
+        elif feature_type == "categorical":
+            level = np.searchsorted(self.levels[j], split)
+            return column == level
+        elif feature_type == "partition":
+            levels = np.searchsorted(self.levels[j], list(split))
+            return np.isin(column, levels)
+        raise TypeError("Something went horribly wrong")
+
+
+def split_column(data, j, rows, bins=None, partition=False):
     """
-    Finds the best feature to split the data on by way of variance reduction.
+    Finds the best split of the given rows of an encoded data matrix on feature column j. If bins from
+    bin_features are given, continuous features are split on their bin codes. If partition is True, categorical
+    features are split into any two groups of levels rather than one level against the rest.
+    Returns the best split level or point, the variance reduction and the split type identifier.
+
+    :param data: DataMatrix
+    :param j: int
+    :param rows: numpy array
+    :param bins: dict
+    :param partition: boolean
+    :return: str, float, str
+    :return: tuple, float, str
+    :return: numeric, float, str
+    """
+    target = data.target[rows]
+    if data.types[j] == "categorical":
+        levels = data.levels[j]
+        level, variance_reduction = sweep_categorical(data.columns[j][rows].astype(np.int64), target, len(levels),
+                                                      partition)
+        if level is None:
+            return None, variance_reduction, "categorical"
+        if partition:
+            return tuple(levels[list(level)]), variance_reduction, "partition"
+        return levels[level], variance_reduction, "categorical"
+    if bins and j in bins:
+        edges, codes = bins[j]
+        best_split, variance_reduction = binned_continuous(codes[rows], edges, target)
+    else:
+        best_split, variance_reduction = sweep_continuous(data.columns[j][rows], target)
+    return best_split, variance_reduction, "continuous"
+
+
+def find_best_split(data, bins=None, rows=None, executor=None, partition=False, considered=None):
+    """
+    Finds the best feature to split the data on by way of variance reduction. If bins from bin_features are given,
+    continuous features are split on their bin codes. The data can be a pandas data frame or a DataMatrix, in which
+    case only the given rows are considered. If a thread pool executor is given, features of large nodes are scored
+    concurrently; the largest variance reduction still wins, with ties going to the first feature in column order.
+    If partition is True, categorical features are split into any two groups of levels. If a considered list is
+    given, the indices of the feature columns weighed are appended to it.
     Returns the best feature and the associated variance reduction.
 
-    :param data: pandas data frame
+    :param data: pandas data frame or DataMatrix
+    :param bins: dict
+    :param rows: numpy array
+    :param executor: concurrent.futures.Executor
+    :param partition: boolean
+    :param considered: list
     :return: str, float
     """
+    if not isinstance(data, DataMatrix):
+        data = DataMatrix(data)
+    if rows is None:
+        rows = np.arange(data.n)
     max_variance_reduction = 0
     best_feature, type_, split = None, None, None
-    for feature in data.columns:
-        if feature == "tg":
-            break
-        result = splitter(data, feature)
+    columns = range(len(data.features))
+    if considered is not None:
+        considered.extend(columns)
+    if executor is not None and len(columns) > 1 and len(rows) >= PARALLEL_MIN_ROWS:
+        results = list(executor.map(lambda column: split_column(data, column, rows, bins, partition), columns))
+    else:
+        results = (split_column(data, column, rows, bins, partition) for column in columns)
+    for feature, result in zip(data.features, results):
         variance_reduction = result[1]
         if variance_reduction > max_variance_reduction:
             best_feature = feature
@@ -112,3 +520,183 @@ def find_best_split(data):
             type_ = result[2]
             max_variance_reduction = variance_reduction
     return type_, best_feature, split, max_variance_reduction
+
+
+class ChunkedData:
+    """
+    A CSV or Parquet file that is read in chunks, so that trees can be trained on more rows than fit in memory.
+    """
+    def __init__(self, path, max_bins=255, chunksize=100000, target="tg"):
+        """
+        Scans a file whose target column is named target once. Every other column is a feature, typed from the
+        first chunk. The scan collects the levels of every categorical feature, the mean of the target, and a
+        quantile sketch of every continuous feature from which its bin edges are chosen.
+
+        :param path: str
+        :param max_bins: int
+        :param chunksize: int
+        :param target: str
+        """
+        if max_bins < 2:
+            raise ValueError("Binned split finding needs at least 2 bins")
+        self.target_column = target
+        self.path = path
+        self.chunksize = chunksize
+        self.features = None
+        self.n = 0
+        sketches, levels = {}, {}
+        target_sum = 0
+        for chunk in read_chunks(path, chunksize):
+            if self.features is None:
+                self.features = [feature for feature in chunk.columns if feature != target]
+                self.types = []
+                for j, feature in enumerate(self.features):
+                    if pd.api.types.is_string_dtype(chunk[feature]):
+                        self.types.append("categorical")
+                        levels[j] = set()
+                    elif pd.api.types.is_numeric_dtype(chunk[feature]):
+                        self.types.append("continuous")
+                        sketches[j] = QuantileSketch(max(8192, 32 * max_bins))
+                    else:
+                        raise TypeError("Feature must be numeric or categorical")
+            for j, feature in enumerate(self.features):
+                if j in sketches:
+                    sketches[j].update(chunk[feature].to_numpy(dtype=float))
+                else:
+                    levels[j].update(chunk[feature].unique())
+            target_sum += chunk[target].to_numpy(dtype=float).sum()
+            self.n += len(chunk.index)
+        if self.features is None:
+            raise ValueError("Cannot train on an empty file")
+        self.levels = [np.array(sorted(levels[j]), dtype=object) if j in levels else None
+                       for j in range(len(self.features))]
+        self.target_mean = target_sum / self.n
+        self.edges = {j: sketch.edges(max_bins) for j, sketch in sketches.items()}
+
+    def __str__(self):
+        """
+        Prints a short description of the chunked data.
+
+        :return: str
+        """
+        return "ChunkedData from " + str(self.path) + " with " + str(self.n) + " rows and features " + \
+               str(self.features)
+
+    def chunks(self):
+        """
+        Reads the file again one chunk at a time. Each chunk is encoded into a DataMatrix with the levels found by
+        the scan, along with its bins in the form that bin_features gives.
+
+        :return: generator
+        """
+        for chunk in read_chunks(self.path, self.chunksize):
+            columns = []
+            bins = {}
+            for j, feature in enumerate(self.features):
+                if self.types[j] == "categorical":
+                    columns.append(pd.Categorical(chunk[feature], categories=self.levels[j]).codes.astype(np.int64))
+                else:
+                    columns.append(chunk[feature].to_numpy(dtype=float))
+                    bins[j] = self.edges[j], bin_codes(columns[j], self.edges[j])
+            target = chunk[self.target_column].to_numpy(dtype=float)
+            yield DataMatrix.from_arrays(self.features, self.types, self.levels, columns, target,
+                                         self.target_column), bins
+
+
+def column_histogram(data, j, rows, bins, shift=0.0):
+    """
+    Adds up the count, the sum and the sum of squares of the target, less shift, for the given rows of an encoded
+    data matrix in every bin (or level) of feature column j.
+    Returns a (3 x bins) or (3 x levels) table.
+
+    :param data: DataMatrix
+    :param j: int
+    :param rows: numpy array
+    :param bins: dict
+    :param shift: float
+    :return: numpy array
+    """
+    if data.types[j] == "categorical":
+        codes = data.columns[j][rows].astype(np.int64)
+        number_bins = len(data.levels[j])
+    else:
+        edges, codes = bins[j]
+        codes = codes[rows]
+        number_bins = len(edges) + 1
+    shifted = data.target[rows] - shift
+    return np.array([np.bincount(codes, minlength=number_bins),
+                     np.bincount(codes, weights=shifted, minlength=number_bins),
+                     np.bincount(codes, weights=shifted ** 2, minlength=number_bins)])
+
+
+def histogram_split(data, j, histogram, partition=False):
+    """
+    Finds the best split on feature column j of chunked data from a table made by column_histogram.
+    Returns the best split level or point, the variance reduction and the split type identifier.
+
+    :param data: ChunkedData
+    :param j: int
+    :param histogram: numpy array
+    :param partition: boolean
+    :return: str, float, str
+    :return: tuple, float, str
+    :return: numeric, float, str
+    """
+    if data.types[j] == "categorical":
+        levels = data.levels[j]
+        level, variance_reduction = categorical_histogram_split(histogram, partition)
+        if level is None:
+            return None, variance_reduction, "categorical"
+        if partition:
+            return tuple(levels[list(level)]), variance_reduction, "partition"
+        return levels[level], variance_reduction, "categorical"
+    best_split, variance_reduction = continuous_histogram_split(histogram, data.edges[j])
+    return best_split, variance_reduction, "continuous"
+
+
+def best_histogram_split(data, histograms, partition=False):
+    """
+    Finds the best feature to split a node of chunked data on by way of variance reduction, from its tables given
+    as a dictionary from feature column index to the table made by column_histogram. The largest variance
+    reduction wins, with ties going to the first feature in column order.
+    Returns the best feature and the associated variance reduction.
+
+    :param data: ChunkedData
+    :param histograms: dict
+    :param partition: boolean
+    :return: str, float
+    """
+    max_variance_reduction = 0
+    best_feature, type_, split = None, None, None
+    for j in sorted(histograms):
+        result = histogram_split(data, j, histograms[j], partition)
+        if result[1] > max_variance_reduction:
+            best_feature = data.features[j]
+            split = result[0]
+            type_ = result[2]
+            max_variance_reduction = result[1]
+    return type_, best_feature, split, max_variance_reduction
+
+
+def histogram_sides(data, histogram, feature_type, feature, split):
+    """
+    Splits a node's table for the feature it is split on into the count, sum and sum of squares of the target of
+    the rows going left and of the rows going right.
+
+    :param data: ChunkedData
+    :param histogram: numpy array
+    :param feature_type: str
+    :param feature: str
+    :param split: numeric or str
+    :return: numpy array, numpy array
+    """
+    j = data.features.index(feature)
+    if feature_type == "continuous":
+        right = np.arange(histogram.shape[1]) > np.searchsorted(data.edges[j], split)
+    elif feature_type == "categorical":
+        right = data.levels[j] == split
+    elif feature_type == "partition":
+        right = np.isin(np.arange(histogram.shape[1]), np.searchsorted(data.levels[j], list(split)))
+    else:
+        raise TypeError("Something went horribly wrong")
+    return histogram[:, ~right].sum(axis=1), histogram[:, right].sum(axis=1)
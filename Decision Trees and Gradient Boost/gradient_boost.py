@@ -12,16 +12,170 @@ class GradientBoost:
     A Gradient Boost algorithm. Uses a series of scaled and leaf-limited decision trees
     to refine the residuals from a regression.
     """
-    def __init__(self, input_data, learning_rate, max_number_trees, max_number_leaves):
-        self.data = input_data
-        initial_prediction = dt.fc.np.mean(input_data["tg"])
-        self.data["tg"] = self.data["tg"] - initial_prediction
-        self.trees = [dt.DecisionTreeReg(self.data, max_leaves=max_number_leaves)]
-        # From here on things get weird...
-        for i in range(2, max_number_trees + 2):
-            self.data["tg"] = self.data["tg"] - learning_rate * self.trees[i - 2].predict_point(self.data)
-            self.trees.append(dt.DecisionTreeReg(self.data, max_leaves=max_number_leaves))
+    def __init__(self, input_data, learning_rate, max_number_trees, max_number_leaves, validation_data=None,
+                 early_stopping_rounds=None, growth="level", stats=None):
+        """
+        Fits a gradient boost model to a pandas data frame with a target column named "tg", or to a
+        functions.DataMatrix such as one memory-mapped from disk by functions.DataMatrix.load. Starts from the mean
+        of the target and fits max_number_trees + 1 trees, each to the residuals left by the ones before it. The
+        caller's data is not changed.
+
+        Each tree writes its prediction for every training row as its leaves are made, so the residuals are
+        updated without walking the tree again.
+
+        If validation_data (a data frame with the same target column, or a DataMatrix with the same features) is
+        given, the mean squared error on it is recorded after every tree in validation_loss. If
+        early_stopping_rounds is also given, training stops once that many trees in a row have failed to improve on
+        the best validation loss, and the trees after the best one are dropped.
+
+        growth is passed to each tree. With "best_first", every tree spends its max_number_leaves leaves on the
+        splits with the largest variance reduction.
+
+        If a functions.BuildStats is given as stats, every node and tree is recorded in it, and the summary of each
+        round's tree also gets the training loss after the round and, with validation data, the validation loss.
+
+        :param input_data: pandas data frame or DataMatrix
+        :param learning_rate: float
+        :param max_number_trees: int
+        :param max_number_leaves: int
+        :param validation_data: pandas data frame or DataMatrix
+        :param early_stopping_rounds: int
+        :param growth: str
+        :param stats: functions.BuildStats
+        """
+        if early_stopping_rounds is not None and validation_data is None:
+            raise ValueError("Early stopping needs validation data")
+        data = input_data if isinstance(input_data, dt.fc.DataMatrix) else dt.fc.DataMatrix(input_data)
+        self.learning_rate = learning_rate
+        self.initial_prediction = dt.fc.np.mean(data.target)
+        residuals = data.target - self.initial_prediction
+        fitted_values = dt.fc.np.empty(data.n)
+        self.trees = []
+        self.compiled = None
+        self.validation_loss = []
+        if validation_data is not None:
+            if isinstance(validation_data, dt.fc.DataMatrix):
+                missing = [feature for feature in data.features if feature not in validation_data.features]
+                if missing:
+                    raise ValueError("Validation data is missing features: " +
+                                     ", ".join(str(feature) for feature in missing))
+                validation_target = validation_data.target
+            else:
+                validation_target = validation_data[data.target_column].to_numpy(dtype=float)
+            # Running predictions on the validation data, so each round only scores its own tree
+            validation_prediction = dt.fc.np.full(len(validation_target), self.initial_prediction)
+            best_round = 0
+        for i in range(0, max_number_trees + 1):
+            tree = dt.DecisionTreeReg(data.with_target(residuals), max_leaves=max_number_leaves,
+                                      fitted_values=fitted_values, growth=growth, stats=stats)
+            self.trees.append(tree)
+            residuals = residuals - learning_rate * fitted_values
+            if stats is not None:
+                stats.annotate(round=i, training_loss=float(dt.fc.np.mean(residuals ** 2)))
+            if validation_data is None:
+                continue
+            if isinstance(validation_data, dt.fc.DataMatrix):
+                validation_prediction += learning_rate * tree.compile().predict_data(validation_data)
+            else:
+                validation_prediction += learning_rate * tree.predict_frame(validation_data)
+            self.validation_loss.append(dt.fc.np.mean((validation_target - validation_prediction) ** 2))
+            if stats is not None:
+                stats.annotate(validation_loss=float(self.validation_loss[-1]))
+            if self.validation_loss[-1] < self.validation_loss[best_round]:
+                best_round = i
+            elif early_stopping_rounds and i - best_round >= early_stopping_rounds:
+                del self.trees[best_round + 1:]
+                break
+
+    def __str__(self):
+        """
+        Prints a simple representation of the gradient boost model.
+
+        :return: str
+        """
+        return "A gradient boost model with initial prediction " + str(self.initial_prediction) + ", learning rate " \
+               + str(self.learning_rate) + " and " + str(len(self.compile())) + " trees"
 
     def predict_point(self, point):
-        # Predict the value of a new point using the gradient boost algorithm
-        pass
+        """
+        Predicts the target value for a new data point, represented as a pandas data frame with a single row.
+
+        :param point: pandas data frame
+        :return: float
+        """
+        if self.trees is None:
+            return self.predict_frame(point)[0]
+        prediction = self.initial_prediction
+        for tree in self.trees:
+            prediction += self.learning_rate * tree.predict_point(point)
+        return prediction
+
+    def compile(self):
+        """
+        Compiles every tree so that they all read the same encoded feature matrix. The result is cached, so the
+        model is only compiled once.
+
+        :return: list
+        """
+        if self.compiled is None:
+            self.compiled = dt.tc.merge_compiled([tree.compile() for tree in self.trees])
+        return self.compiled
+
+    def save(self, path):
+        """
+        Saves the compiled model to one binary model file that GradientBoost.load can memory-map. Only the trees'
+        structure, the initial prediction and the learning rate are written, never the training data.
+
+        :param path: str
+        """
+        dt.tc.save_compiled(path, "GradientBoost", self.compile(),
+                            {"initial_prediction": float(self.initial_prediction),
+                             "learning_rate": float(self.learning_rate)})
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a gradient boost model saved by GradientBoost.save. The file is memory-mapped and every tree is a
+        view of it, so loading takes milliseconds even for many trees and processes that load the same file share
+        its pages. The loaded model has no DecisionTreeReg objects, so it predicts with its compiled trees.
+
+        :param path: str
+        :return: GradientBoost
+        """
+        model = cls.__new__(cls)
+        header, model.compiled = dt.load_compiled(path, "GradientBoost")
+        model.initial_prediction = header["extra"]["initial_prediction"]
+        model.learning_rate = header["extra"]["learning_rate"]
+        model.trees = None
+        model.validation_loss = []
+        return model
+
+    def predict_frame(self, frame):
+        """
+        Predicts the target value for every row of a pandas data frame at once, using the compiled trees. The frame
+        is encoded once for all the trees.
+
+        :param frame: pandas data frame
+        :return: numpy array
+        """
+        trees = self.compile()
+        matrix = trees[0].encode(frame)
+        prediction = dt.fc.np.full(len(frame.index), self.initial_prediction)
+        for tree in trees:
+            prediction += self.learning_rate * tree.value[tree.apply(matrix)]
+        return prediction
+
+    def staged_predict(self, frame):
+        """
+        Yields the predicted target values for every row of a pandas data frame after each tree in turn, so the
+        model can be evaluated at every number of trees in one pass.
+
+        :param frame: pandas data frame
+        :return: generator of numpy arrays
+        """
+        trees = self.compile()
+        matrix = trees[0].encode(frame)
+        prediction = dt.fc.np.full(len(frame.index), self.initial_prediction)
+        for tree in trees:
+            prediction += self.learning_rate * tree.value[tree.apply(matrix)]
+            yield prediction.copy()
@@ -5,31 +5,50 @@ Implements decision tree objects and decision tree node objects
 """
 
 import functions as fc
-
+import tree_common as tc
+from concurrent.futures import ThreadPoolExecutor
+from heapq import heappush, heappop
 
 class DecisionTreeNode:
     """
     A decision tree node
     """
 
-    def __init__(self, input_data, random_subset=False):
+    def __init__(self, input_data, rows, random_subset=False, bins=None, random_state=None, executor=None,
+                 partition=False, search=True, considered=None):
         """
-        Initializes a new Decision Tree Node. If random_subset is True, only chooses features from a random subset,
-        newly created at each node.
+        Initializes a new Decision Tree Node on the given rows of an encoded data matrix. The node only keeps the
+        row indices until its children are made, and keeps its size and majority label as plain values. If
+        random_subset is True, only chooses features from a random subset, newly created at each node and drawn with
+        random_state (a random.Random) if given. If bins from functions.bin_features are given, numeric features
+        are split on their bin codes. If a thread pool executor is given, features are scored concurrently. If
+        partition is True, categorical features can be split into two groups of levels. If search is False, the
+        node is made a leaf without looking for a split. If a considered list is given, the indices of the feature
+        columns weighed for the split are appended to it.
 
-        :param input_data: pandas data frame
+        :param input_data: DataMatrix
+        :param rows: numpy array
         :param random_subset: boolean
+        :param bins: dict
+        :param random_state: random.Random
+        :param executor: concurrent.futures.Executor
+        :param partition: boolean
+        :param search: boolean
+        :param considered: list
         """
-        self.input_data = input_data
-        self.n = max(input_data.count())
+        self.rows = rows
+        self.n = len(rows)
         self.left, self.right = None, None
+        label_counts = fc.np.bincount(input_data.labels[rows], minlength=len(input_data.classes))
+        self.label = input_data.classes[fc.np.argmax(label_counts)]
         # If you pass trivial input data or fewer than 10 items, just create a leaf
-        if fc.entropy(input_data) == 0 or max(input_data.count()) < 10:
+        if not search or fc.counts_entropy(label_counts) == 0 or self.n < 10:
             self.leaf = True
             self.decision = None, None, None
             self.information_gain = 0
         else:
-            result = fc.best_split(input_data, random_subset)
+            result = fc.best_split(input_data, random_subset, bins, rows, random_state, executor, partition,
+                                   considered)
             feature_type = result[0]
             best_feature = result[1]
             split = result[2]
@@ -42,6 +61,27 @@ class DecisionTreeNode:
                 # Otherwise, node is not a leaf and has a decision type
                 self.leaf = False
                 self.decision = feature_type, best_feature, split
+        if self.leaf:
+            self.rows = None
+
+    @classmethod
+    def from_counts(cls, classes, label_counts):
+        """
+        Makes a leaf from the label counts of the rows that reach it, for trees grown without the rows in memory.
+
+        :param classes: numpy array
+        :param label_counts: numpy array
+        :return: DecisionTreeNode
+        """
+        node = cls.__new__(cls)
+        node.rows = None
+        node.n = int(round(label_counts.sum()))
+        node.left, node.right = None, None
+        node.label = classes[fc.np.argmax(label_counts)]
+        node.leaf = True
+        node.decision = None, None, None
+        node.information_gain = 0
+        return node
 
     def __str__(self):
         """
@@ -62,41 +102,33 @@ class DecisionTreeNode:
                str(feature) + "' split on '" + str(split) + \
                "' and information gain: " + str(gain) + " with majority: '" + str(self.majority()) + "'"
 
-    def pass_right(self):
+    def pass_right(self, input_data):
         """
-        Takes a pandas data frame, passes the appropriate portion downstream to the right node.
+        Takes the encoded data matrix, passes the indices of this node's rows that go downstream to the right node.
 
-        :return: pandas data frame
+        :param input_data: DataMatrix
+        :return: numpy array
         """
         feature_type = self.decision[0]
         feature = self.decision[1]
         split = self.decision[2]
-        if feature_type == "numeric":
-            return self.input_data[self.input_data[feature] > split]
-        elif feature_type == "categorical":
-            return self.input_data[self.input_data[feature] == split]
-        elif not feature_type:
-            pass
-        else:
-            raise TypeError("Something went horribly wrong")
+        if not feature_type:
+            return None
+        return self.rows[input_data.pass_rows(self.rows, feature_type, feature, split)]
 
-    def pass_left(self):
+    def pass_left(self, input_data):
         """
-        Takes a dataframe, passes the appropriate portion downstream to the left node.
+        Takes the encoded data matrix, passes the indices of this node's rows that go downstream to the left node.
 
-        :return: pandas data frame
+        :param input_data: DataMatrix
+        :return: numpy array
         """
         feature_type = self.decision[0]
         feature = self.decision[1]
         split = self.decision[2]
-        if feature_type == "numeric":
-            return self.input_data[self.input_data[feature] <= split]
-        elif feature_type == "categorical":
-            return self.input_data[self.input_data[feature] != split]
-        elif not feature_type:
-            pass
-        else:
-            raise TypeError("Something went horribly wrong")
+        if not feature_type:
+            return None
+        return self.rows[~input_data.pass_rows(self.rows, feature_type, feature, split)]
 
     def send_datapoint(self, datapoint):
         """
@@ -117,43 +149,137 @@ class DecisionTreeNode:
             if datapoint[feature].values[0] == split:
                 return 1
             return 0
+        elif feature_type == "partition":
+            if datapoint[feature].values[0] in split:
+                return 1
+            return 0
         elif not feature_type:
             pass
         else:
             raise TypeError("Something went horribly wrong")
 
     def majority(self):
-        label_list = self.input_data["lbl"].tolist()
-        labels = set(label_list)
-        max_item = None
-        max_count = 0
-        for item in labels:
-            count = label_list.count(item)
-            if count > max_count:
-                max_item = item
-                max_count = count
-        return max_item
+        """
+        Returns the most common label among the data points that reached this node during training.
+
+        :return: str
+        """
+        return self.label
 
     def view_graphic(self):
         # Should display a box with condition for split written in text
         pass
 
 
+class CompiledTree(tc.CompiledTree):
+    """
+    A trained decision tree flattened into parallel numpy arrays, one entry per node, as tree_common.CompiledTree,
+    whose leaf values are indices into its classes.
+    """
+
+    value_type = fc.np.int64
+
+    def __init__(self, features, categorical, levels, feature, threshold, left, right, value, groups, classes):
+        """
+        Creates a compiled tree as tree_common.CompiledTree does. The prediction at node i is classes[value[i]].
+
+        :param features: list
+        :param categorical: list
+        :param levels: list
+        :param feature: list
+        :param threshold: list
+        :param left: list
+        :param right: list
+        :param value: list
+        :param groups: list
+        :param classes: list
+        """
+        super().__init__(features, categorical, levels, feature, threshold, left, right, value, groups)
+        self.classes = fc.np.array(classes, dtype=object)
+
+    def classify(self, frame):
+        """
+        Classifies every row of a pandas data frame.
+
+        :param frame: pandas data frame
+        :return: numpy array
+        """
+        return self.classes[self.value[self.apply(self.encode(frame))]]
+
+
 class DecisionTree:
     """
     A decision tree.
     """
 
-    def __init__(self, input_data, max_levels=None, random_subset=False):
+    def __init__(self, input_data, max_levels=None, random_subset=False, binned=False, max_bins=255, rows=None,
+                 random_state=None, n_jobs=None, category_partitions=False, growth="level", max_leaves=None,
+                 stats=None):
         """
         Creates a new DecisionTree as a nested list of DecisionTreeNode objects organized by level. If random_subset
-        is True, only chooses features from a random subset at each node.
+        is True, only chooses features from a random subset at each node. If binned is True, every numeric feature
+        is quantized once into at most max_bins bins and each node splits on per-bin label counts. Splits still
+        land on real feature values.
+
+        The input data is encoded once into a functions.DataMatrix, or can be passed as one already so that
+        several trees share it, for example one memory-mapped from disk by functions.DataMatrix.load. If rows are
+        given, the tree is trained on those rows only (repeats allowed). Setting random_state seeds the random
+        feature subsets, so the same seed always grows the same tree. If n_jobs is more than 1, the features of
+        large nodes are scored concurrently in that many threads.
+
+        Categorical features are split on one group against the rest. If category_partitions is True, they are
+        split into two groups of levels instead, found by sorting the levels by their share of the most common
+        label.
+
+        By default the tree grows one level at a time, splitting nodes in order until it has max_leaves leaves. If
+        growth is "best_first", it always splits the node with the highest information gain next instead. Either
+        way, no node is split deeper than max_levels.
+
+        If a functions.BuildStats is given as stats, every node made and the tree as a whole are recorded in it.
 
-        :param input_data: pandas data frame
+        :param input_data: pandas data frame or DataMatrix
         :param max_levels: int
         :param random_subset: boolean
+        :param binned: boolean
+        :param max_bins: int
+        :param rows: numpy array
+        :param random_state: int
+        :param n_jobs: int
+        :param category_partitions: boolean
+        :param growth: str
+        :param max_leaves: int
+        :param stats: functions.BuildStats
         """
-        self.nodes = [[DecisionTreeNode(input_data, random_subset)]]
+        if growth not in ("level", "best_first"):
+            raise ValueError("Growth must be 'level' or 'best_first'")
+        if not isinstance(input_data, fc.DataMatrix):
+            input_data = fc.DataMatrix(input_data)
+        if rows is None:
+            rows = fc.np.arange(input_data.n)
+        bins = None
+        if binned:
+            bins = fc.bin_features(input_data, max_bins)
+        if random_state is not None:
+            random_state = fc.Random(random_state)
+        executor = ThreadPoolExecutor(max_workers=n_jobs) if n_jobs and n_jobs > 1 else None
+
+        # This function makes a new node at the given depth, which only looks for a split if search is True
+        def make_node(rows_, depth, search=True):
+            if stats is None:
+                return DecisionTreeNode(input_data, rows_, random_subset, bins, random_state, executor,
+                                        category_partitions, search)
+            considered = []
+            start = fc.time.perf_counter()
+            node_ = DecisionTreeNode(input_data, rows_, random_subset, bins, random_state, executor,
+                                     category_partitions, search, considered)
+            stats.record_node(node_, depth, fc.time.perf_counter() - start, node_.information_gain,
+                              fc.candidate_counts(input_data, rows_, considered, bins, category_partitions))
+            return node_
+
+        if stats is not None:
+            stats.start_tree()
+        self.nodes = [[make_node(rows, 0)]]
+        self.compiled = None
         current_level = 0
 
         # This function checks whether all the nodes on your current level are leafs
@@ -168,21 +294,92 @@ class DecisionTree:
                     leafs += 1
             return number_nodes == leafs
 
-        # Keep building a tree until all nodes on current level are leafs
-        while not all_leafs(self.nodes[current_level]):
-            next_level_list = []
-            for node in self.nodes[current_level]:
-                if not node.leaf:
-                    left_node = DecisionTreeNode(node.pass_left(), random_subset)
-                    right_node = DecisionTreeNode(node.pass_right(), random_subset)
-                    node.left = left_node
-                    node.right = right_node
-                    next_level_list.append(left_node)
-                    next_level_list.append(right_node)
-            self.nodes.append(next_level_list)
-            current_level += 1
-            if max_levels and current_level == max_levels:
-                break
+        if growth == "level":
+            current_leaves = 1
+            # Keep building a tree until all nodes on current level are leafs
+            while not all_leafs(self.nodes[current_level]):
+                next_level_list = []
+                for node in self.nodes[current_level]:
+                    if max_leaves and current_leaves == max_leaves:
+                        break
+                    if not node.leaf:
+                        left_node = make_node(node.pass_left(input_data), current_level + 1)
+                        right_node = make_node(node.pass_right(input_data), current_level + 1)
+                        node.left = left_node
+                        node.right = right_node
+                        node.rows = None
+                        next_level_list.append(left_node)
+                        next_level_list.append(right_node)
+                        current_leaves += 1
+                self.nodes.append(next_level_list)
+                current_level += 1
+                if max_levels and current_level == max_levels:
+                    break
+                if max_leaves and current_leaves == max_leaves:
+                    break
+            # The last level, and any nodes of the level before it left over when the leaf budget ran out
+            unsplit = [node for level in self.nodes[-2:] for node in level if node.left is None]
+        else:
+            # Keep splitting the candidate node with the highest information gain, weighted by the node's size, until
+            # the leaf budget is spent
+            candidates = []
+            if not self.nodes[0][0].leaf:
+                root = self.nodes[0][0]
+                heappush(candidates, (-root.information_gain * root.n, 0, 0, root))
+            current_leaves = 1
+            pushed = 1
+            while candidates and (not max_leaves or current_leaves < max_leaves):
+                node_level, node = heappop(candidates)[2:]
+                current_leaves += 1
+                # Only look for splits in the children if they could still be split themselves
+                search = (not max_leaves or current_leaves < max_leaves) and \
+                         (not max_levels or node_level + 1 < max_levels)
+                node.left = make_node(node.pass_left(input_data), node_level + 1, search)
+                node.right = make_node(node.pass_right(input_data), node_level + 1, search)
+                node.rows = None
+                if len(self.nodes) == node_level + 1:
+                    self.nodes.append([])
+                for child in (node.left, node.right):
+                    self.nodes[node_level + 1].append(child)
+                    if not child.leaf:
+                        heappush(candidates, (-child.information_gain * child.n, pushed, node_level + 1, child))
+                        pushed += 1
+            unsplit = [candidate[3] for candidate in candidates]
+
+        if executor is not None:
+            executor.shutdown()
+
+        # Nodes left unsplit when the level or leaf limit was reached become leafs
+        for node in unsplit:
+            if not node.leaf:
+                node.leaf = True
+                node.decision = None, None, None
+                node.information_gain = 0
+                node.rows = None
+        if stats is not None:
+            stats.end_tree(self)
+
+    @classmethod
+    def from_chunks(cls, source, max_levels=None, random_subset=False, max_bins=255, chunksize=100000,
+                    random_state=None, category_partitions=False):
+        """
+        Grows a decision tree on a CSV or Parquet file too large to load, reading it in chunks. The file is scanned
+        once for the bin edges of every numeric feature, then read once more for every level of the tree, adding
+        up per-bin label counts for the nodes still to be split. Memory use depends on the number of bins and
+        nodes, not on the number of rows. The tree grows level by level and splits as a binned DecisionTree does.
+
+        :param source: str or functions.ChunkedData
+        :param max_levels: int
+        :param random_subset: boolean
+        :param max_bins: int
+        :param chunksize: int
+        :param random_state: int
+        :param category_partitions: boolean
+        :return: DecisionTree
+        """
+        if not isinstance(source, fc.ChunkedData):
+            source = fc.ChunkedData(source, max_bins, chunksize)
+        return grow_chunked(source, [None], max_levels, random_subset, [random_state], category_partitions)[0]
 
     def __str__(self):
         """
@@ -210,6 +407,102 @@ class DecisionTree:
         # displays a graphic of all the nodes and connections in the decision tree
         pass
 
+    def compile(self):
+        """
+        Compiles the trained tree into a CompiledTree of flat numpy arrays for fast batch classification.
+        The result is cached, so the tree is only compiled once.
+
+        :return: CompiledTree
+        """
+        if self.compiled is not None:
+            return self.compiled
+        classes = sorted(set(node.label for level in self.nodes for node in level))
+        class_index = {label: i for i, label in enumerate(classes)}
+        order = [self.nodes[0][0]]
+        features, categorical, levels, groups = [], [], [], []
+        feature, threshold, left, right, values = [], [], [], [], []
+        i = 0
+        while i < len(order):
+            node = order[i]
+            values.append(class_index[node.label])
+            if node.leaf:
+                feature.append(-1)
+                threshold.append(0)
+                left.append(-1)
+                right.append(-1)
+            else:
+                feature_type, name, split = node.decision
+                if name not in features:
+                    features.append(name)
+                    categorical.append(feature_type != "numeric")
+                    levels.append([] if categorical[-1] else None)
+                k = features.index(name)
+                if categorical[k]:
+                    group = [split] if feature_type == "categorical" else list(split)
+                    for level in group:
+                        if level not in levels[k]:
+                            levels[k].append(level)
+                    groups.append([levels[k].index(level) for level in group])
+                    split = len(groups) - 1
+                feature.append(k)
+                threshold.append(split)
+                left.append(len(order))
+                right.append(len(order) + 1)
+                order.append(node.left)
+                order.append(node.right)
+            i += 1
+        self.compiled = CompiledTree(features, categorical, levels, feature, threshold, left, right, values,
+                                     groups, classes)
+        return self.compiled
+
+    def feature_gains(self):
+        """
+        Adds up, for every feature, the information gain of each node that splits on it weighted by the number of
+        rows that reach the node.
+
+        :return: dict
+        """
+        gains = {}
+        for level in self.nodes:
+            for node in level:
+                if not node.leaf:
+                    gains[node.decision[1]] = gains.get(node.decision[1], 0) + node.information_gain * node.n
+        return gains
+
+    def classify_frame(self, frame):
+        """
+        Classifies every row of a pandas data frame at once, using the compiled tree.
+
+        :param frame: pandas data frame
+        :return: numpy array
+        """
+        return self.compile().classify(frame)
+
+    def save(self, path):
+        """
+        Saves the compiled tree to a binary model file that DecisionTree.load can memory-map. Only the tree's
+        structure is written, never its training data.
+
+        :param path: str
+        """
+        compiled = self.compile()
+        tc.save_compiled(path, "DecisionTree", [compiled], classes=compiled.classes)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a decision tree saved by DecisionTree.save. The file is memory-mapped, so loading is almost instant
+        and processes that load the same file share its pages. The loaded tree has no node objects, so it
+        classifies with its compiled arrays.
+
+        :param path: str
+        :return: DecisionTree
+        """
+        tree = cls.__new__(cls)
+        tree.nodes = None
+        tree.compiled = load_compiled(path, "DecisionTree")[1][0]
+        return tree
+
     def classify_point(self, datapoint):
         """
         Classifies a new data point, represented as a pandas data frame with a single row.
@@ -217,6 +510,8 @@ class DecisionTree:
         :param datapoint: pandas data frame
         :return: str
         """
+        if self.nodes is None:
+            return self.classify_frame(datapoint)[0]
         current_node = self.nodes[0][0]
         while not current_node.leaf:
             if current_node.send_datapoint(datapoint):
@@ -229,3 +524,175 @@ class DecisionTree:
         # takes a data point as input
         # display a graphic with the path that the point takes highlighted
         pass
+
+
+def add_histograms(matrix, bins, weights, histograms, rows):
+    """
+    Adds the label counts of the given rows of a chunk to a node's histograms, a dictionary from feature column
+    index to the table made by functions.column_histogram.
+
+    :param matrix: DataMatrix
+    :param bins: dict
+    :param weights: numpy array
+    :param histograms: dict
+    :param rows: numpy array
+    """
+    for j in histograms:
+        histograms[j] = histograms[j] + fc.column_histogram(matrix, j, rows, bins, weights)
+
+
+def route_chunk(matrix, bins, weights, counting, active, t, node, rows):
+    """
+    Sends the given rows of a chunk down from a split node of tree t, adding them to the histograms of the nodes
+    waiting to be made below it. Waiting nodes are looked up in counting by tree, parent and side. Rows are only
+    sent into subtrees whose nodes' ids are in active, the set of nodes with waiting nodes below them.
+
+    :param matrix: DataMatrix
+    :param bins: dict
+    :param weights: numpy array
+    :param counting: dict
+    :param active: set
+    :param t: int
+    :param node: DecisionTreeNode
+    :param rows: numpy array
+    """
+    go_right = matrix.pass_rows(rows, *node.decision)
+    for side, child, child_rows in ((0, node.left, rows[~go_right]), (1, node.right, rows[go_right])):
+        if child is None:
+            entry = counting.get((t, id(node), side))
+            if entry is not None:
+                add_histograms(matrix, bins, weights, entry[5], child_rows)
+        elif id(child) in active:
+            route_chunk(matrix, bins, weights, counting, active, t, child, child_rows)
+
+
+def grow_chunked(data, bootstrap_seeds, max_levels=None, random_subset=False, random_states=None, partition=False):
+    """
+    Grows one decision tree for every bootstrap seed on chunked data, together and level by level, so that every
+    level of every tree takes one more read of the file. A tree whose seed is None sees every row once. Otherwise
+    each row of each chunk is counted a Poisson(1) number of times, drawn from the seed and the chunk's position,
+    which stands in for a bootstrap sample. Each random state seeds its tree's random feature subsets.
+
+    Every node still to be split adds up a table of label counts for each feature it may split on. When a node
+    splits, the label counts of its children come from the table of the chosen feature, so a child that is bound
+    to be a leaf is never counted again.
+
+    :param data: functions.ChunkedData
+    :param bootstrap_seeds: list
+    :param max_levels: int
+    :param random_subset: boolean
+    :param random_states: list
+    :param partition: boolean
+    :return: list
+    """
+    number_features = len(data.features)
+    trees = []
+    generators = []
+    for random_state in random_states or [None] * len(bootstrap_seeds):
+        tree = DecisionTree.__new__(DecisionTree)
+        tree.nodes = []
+        tree.compiled = None
+        trees.append(tree)
+        generators.append(fc.Random(random_state) if random_state is not None else None)
+
+    # This function chooses the feature columns that a node may split on
+    def choose_columns(t):
+        columns = list(range(number_features))
+        if random_subset:
+            draw = generators[t].sample if generators[t] is not None else fc.sample
+            columns = sorted(draw(columns, fc.floor(fc.np.log2(number_features + 1))))
+        return columns
+
+    # Every node waiting to be made is [tree, parent, side, level, label counts, histograms]. The root's label
+    # counts are only known once its histograms have been added up
+    parents = {}
+    waiting = [[t, None, None, 0, None, {j: 0 for j in choose_columns(t)}] for t in range(len(trees))]
+    while waiting:
+        counting = {}
+        active = set()
+        for entry in waiting:
+            if entry[5]:
+                counting[(entry[0], None if entry[1] is None else id(entry[1]), entry[2])] = entry
+                # Mark every node above the waiting node, so rows are only routed where they are counted
+                node = entry[1]
+                while node is not None and id(node) not in active:
+                    active.add(id(node))
+                    node = parents.get(id(node))
+        if counting:
+            for c, (matrix, bins) in enumerate(data.chunks()):
+                for t, tree in enumerate(trees):
+                    weights = None
+                    rows = fc.np.arange(matrix.n)
+                    if bootstrap_seeds[t] is not None:
+                        weights = fc.np.random.default_rng([bootstrap_seeds[t], c]).poisson(1.0, matrix.n)
+                        rows = fc.np.flatnonzero(weights)
+                    if tree.nodes:
+                        if id(tree.nodes[0][0]) in active:
+                            route_chunk(matrix, bins, weights, counting, active, t, tree.nodes[0][0], rows)
+                    elif (t, None, None) in counting:
+                        add_histograms(matrix, bins, weights, counting[(t, None, None)][5], rows)
+
+        next_waiting = []
+        for t, parent, side, level, label_counts, histograms in waiting:
+            if label_counts is None:
+                label_counts = next(iter(histograms.values())).sum(axis=0)
+            node = DecisionTreeNode.from_counts(data.classes, label_counts)
+            tree = trees[t]
+            if parent is None:
+                tree.nodes.append([node])
+            else:
+                if len(tree.nodes) == level:
+                    tree.nodes.append([])
+                tree.nodes[level].append(node)
+                parents[id(node)] = parent
+                if side:
+                    parent.right = node
+                else:
+                    parent.left = node
+            if not histograms or fc.counts_entropy(label_counts) == 0 or label_counts.sum() < 10:
+                continue
+            result = fc.best_histogram_split(data, histograms, partition)
+            if result[3] == 0:
+                continue
+            node.leaf = False
+            node.decision = result[:3]
+            node.information_gain = result[3]
+            sides = fc.histogram_sides(data, histograms[data.features.index(result[1])], *node.decision)
+            for child_side, child_counts in enumerate(sides):
+                # Children on the last level, with a single label or with fewer than 10 rows are bound to be leafs
+                search = (not max_levels or level + 1 < max_levels) and \
+                    fc.counts_entropy(child_counts) > 0 and child_counts.sum() >= 10
+                next_waiting.append([t, node, child_side, level + 1, child_counts,
+                                     {j: 0 for j in choose_columns(t)} if search else {}])
+        waiting = next_waiting
+    return trees
+
+
+def merge_compiled(trees, classes):
+    """
+    Remaps compiled trees onto one shared list of features and levels with tree_common.merge_compiled, and onto one
+    list of classes, so that they all read the same encoded feature matrix and give their predictions as indices
+    into classes.
+
+    :param trees: list
+    :param classes: numpy array
+    :return: list
+    """
+    class_index = {label: i for i, label in enumerate(classes)}
+    merged = tc.merge_compiled(trees)
+    for tree, original in zip(merged, trees):
+        tree.value = fc.np.array([class_index[label] for label in original.classes], dtype=fc.np.int64)[tree.value]
+        tree.classes = fc.np.array(classes, dtype=object)
+    return merged
+
+
+def load_compiled(path, model):
+    """
+    Memory-maps a model file written by tree_common.save_compiled, with its trees rebuilt as CompiledTree objects
+    that classify.
+
+    :param path: str
+    :param model: str
+    :return: dict, list
+    """
+    return tc.load_compiled(path, model, CompiledTree)
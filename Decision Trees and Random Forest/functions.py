@@ -4,11 +4,46 @@ Implements all the functions that the decision tree and random forest objects re
 @author: Artem Naida
 """
 
+import json
+import os
+import sys
+import time
 import numpy as np
 import pandas as pd
-from random import sample
+from random import sample, Random
 from math import floor
 
+# The pieces both tree packages share are in tree_common.py, in the Decision Trees Common folder beside this one
+COMMON = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Decision Trees Common")
+if COMMON not in sys.path:
+    sys.path.append(COMMON)
+from tree_common import (BuildStats, QuantileSketch, bin_codes, candidate_counts, json_values, quantile_edges,
+                         read_chunks)
+
+# Nodes with fewer rows than this score their features one at a time even when a thread pool is given
+PARALLEL_MIN_ROWS = 10000
+
+# Sorted points whose running class counts sweep_numeric holds at once, which bounds its memory for many classes
+SWEEP_BLOCK = 4096
+
+# Version of the on-disk dataset format written by DataMatrix.save
+DATASET_FORMAT = 1
+
+
+def counts_entropy(counts):
+    """
+    Calculates the information entropy of one or more sets of class counts. Each set of counts runs along the
+    last axis, so a 2D array gives one entropy per row.
+
+    :param counts: numpy array
+    :return: float or numpy array
+    """
+    counts = np.asarray(counts, dtype=float)
+    totals = counts.sum(axis=-1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        probabilities = np.where(counts > 0, counts / totals, 1)
+    return -1 * np.sum(probabilities * np.log2(probabilities), axis=-1)
+
 
 def entropy(data):
     """
@@ -17,15 +52,85 @@ def entropy(data):
     :param data: pandas data frame
     :return: float
     """
-    data_labels = data["lbl"].tolist()
-    n = len(data_labels)
-    total_entropy = 0
-    for label in set(data_labels):
-        label_count = data_labels.count(label)
-        label_probability = label_count / n
-        label_entropy = -1 * label_probability * np.log2(label_probability)
-        total_entropy += label_entropy
-    return total_entropy
+    return float(counts_entropy(data["lbl"].value_counts().to_numpy()))
+
+
+def sweep_numeric(values, labels, number_classes):
+    """
+    Finds the best split for continuous data using maximum information gain, from one sorted sweep that keeps
+    running per-class counts on the left of every candidate split. Labels must be integer codes below
+    number_classes. Points at or below the split go left, points above it go right.
+
+    Only values inside the overlap region of the first point's label and all the other labels are tried. If that
+    region is empty, its midpoint is returned along with the gain it gives.
+
+    Returns the value at which to split and the resulting information gain.
+
+    :param values: numpy array
+    :param labels: numpy array
+    :param number_classes: int
+    :return: float, float
+    """
+    n = len(values)
+    total_counts = np.bincount(labels, minlength=number_classes)
+    input_entropy = counts_entropy(total_counts)
+    # If you send trivial data, give a trivial result
+    if input_entropy == 0:
+        return None, 0
+
+    # If you pass just 2 data points, give a trivial split
+    if n == 2:
+        return (values[0] + values[1]) / 2, float(input_entropy)
+
+    # Find where the points sharing the first point's label overlap with all the others
+    first_label = labels == labels[0]
+    x, y = values[first_label], values[~first_label]
+    overlap = max(y.min(), x.min()), min(y.max(), x.max())
+    overlap_middle = (overlap[0] + overlap[1]) / 2  # If no split reduces entropy, just returns this trivial split
+
+    order = np.argsort(values, kind="mergesort")
+    sorted_values = values[order]
+    sorted_labels = labels[order]
+
+    def information_gain(positions):
+        # Class counts are kept running over blocks of sorted points, so only SWEEP_BLOCK rows of them are held at
+        # once however many points and classes there are. Positions must be in ascending order
+        gains = np.empty(len(positions))
+        running = np.zeros(number_classes, dtype=np.int64)
+        for start in range(0, n, SWEEP_BLOCK):
+            stop = min(start + SWEEP_BLOCK, n)
+            first, last = np.searchsorted(positions, [start, stop])
+            if first < last:
+                block = np.zeros((stop - start, number_classes), dtype=np.int64)
+                block[np.arange(stop - start), sorted_labels[start:stop]] = 1
+                np.cumsum(block, axis=0, out=block)
+                left = block[positions[first:last] - start] + running
+                left_n = positions[first:last] + 1
+                resulting_entropy = (left_n * counts_entropy(left) +
+                                     (n - left_n) * counts_entropy(total_counts - left)) / n
+                gains[first:last] = input_entropy - resulting_entropy
+            running += np.bincount(sorted_labels[start:stop], minlength=number_classes)
+        return gains
+
+    if overlap[0] > overlap[1]:  # If no overlapping items, return midpoint of empty region and associated entropy
+        position = np.searchsorted(sorted_values, overlap_middle, side="right") - 1
+        return overlap_middle, float(information_gain(np.array([position]))[0])
+
+    # See if any point in the overlap region gives a better split, leaving out the largest value
+    distinct, first_seen, counts = np.unique(values, return_index=True, return_counts=True)
+    last_position = np.cumsum(counts) - 1
+    candidates = np.flatnonzero((distinct >= overlap[0]) & (distinct <= overlap[1]) & (last_position < n - 1))
+    if len(candidates) == 0:
+        return overlap_middle, 0
+
+    gains = information_gain(last_position[candidates])
+    maximum_information_gain = gains.max()
+    if not maximum_information_gain > 0:
+        return overlap_middle, 0
+    # Gains that only differ by rounding error count as ties
+    ties = np.flatnonzero(np.isclose(gains, maximum_information_gain, rtol=1e-12, atol=0))
+    best = ties[np.argmin(first_seen[candidates[ties]])]
+    return distinct[candidates[best]].item(), float(gains[best])
 
 
 def numeric_splitter(data, feature):
@@ -38,68 +143,147 @@ def numeric_splitter(data, feature):
     :param feature: str
     :return: float, float
     """
-    # If you send trivial data, give a trivial result
-    input_entropy = entropy(data)
-    if input_entropy == 0:
-        return None, 0, "numeric"
+    labels, classes = pd.factorize(data["lbl"])
+    split, information_gain = sweep_numeric(data[feature].to_numpy(), labels, len(classes))
+    return split, information_gain, "numeric"
 
-    # Otherwise, get to work! Create pairs of values and labels to work with
-    maximum_information_gain = 0
-    pairs = []
-    for pair in data[[feature, "lbl"]].values:
-        pairs.append(tuple(pair))
 
-    # If you pass just 2 data points, give a trivial split
-    if len(pairs) == 2:
-        midpoint = (pairs[0][0] + pairs[1][0]) / 2
-        return midpoint, input_entropy, "numeric"
-
-    # TODO: this while loop is just to delete 'x' and 'y' after use, is this necessary?
-    while 1:
-        x = []
-        y = []
-        for item in pairs:
-            if item[1] == pairs[0][1]:
-                x.append(item[0])
-            else:
-                y.append(item[0])
-        overlap = max(min(y), min(x)), min(max(y), max(x))
-        break
+def bin_features(data, max_bins=255):
+    """
+    Quantizes every numeric feature of an encoded data matrix once, for binned split finding.
 
-    # Just consider items in the overlap region
-    overlap_items = [item for item in pairs if (overlap[0] <= item[0] <= overlap[1])]
-    overlap_middle = (overlap[0] + overlap[1]) / 2 # If no split reduces entropy, just returns this trivial split
+    Returns a dictionary from each numeric feature's column index to its split candidates and bin codes.
 
-    if not overlap_items: # If no overlapping items, return midpoint of empty region and associated entropy
-        trivial_split = overlap_middle
-        n = len(data.index)
-        m = len(data[data[feature] > trivial_split].index)
+    :param data: DataMatrix
+    :param max_bins: int
+    :return: dict
+    """
+    if max_bins < 2:
+        raise ValueError("Binned split finding needs at least 2 bins")
+    bins = {}
+    for j, feature_type in enumerate(data.types):
+        if feature_type == "numeric":
+            values = data.columns[j]
+            edges = quantile_edges(values, max_bins)
+            bins[j] = edges, bin_codes(values, edges)
+    return bins
+
+
+def binned_numeric(codes, edges, labels, number_classes):
+    """
+    Finds the best split for binned continuous data using maximum information gain. Per-bin class counts are built
+    in one pass and every split between bins is scored from their running totals.
 
-        dfr1 = data[data[feature] > trivial_split]
-        dfr2 = data[data[feature] <= trivial_split]
+    Returns the value at which to split and the resulting information gain.
 
-        trivial_split_entropy = (m / n) * entropy(dfr1) + ((n - m) / n) * entropy(dfr2)
-        trivial_information_gain = input_entropy - trivial_split_entropy
-        return trivial_split, trivial_information_gain, "numeric"
+    :param codes: numpy array
+    :param edges: numpy array
+    :param labels: numpy array
+    :param number_classes: int
+    :return: float, float
+    """
+    number_bins = len(edges) + 1
+    histogram = np.bincount(codes.astype(np.int64) * number_classes + labels,
+                            minlength=number_bins * number_classes).reshape(number_bins, number_classes)
+    return numeric_histogram_split(histogram, edges)
 
-    # See if any point in the overlap region gives a better split
-    best_split = overlap_middle
-    for item in overlap_items:
-        split = item[0]
-        n = len(data.index)
-        m = len(data[data[feature] > split].index)
 
-        dfr1 = data[data[feature] > split]
-        dfr2 = data[data[feature] <= split]
+def numeric_histogram_split(histogram, edges):
+    """
+    Finds the best split for binned continuous data from its (bins x classes) table of label counts, which may be
+    weighted. Every split between bins is scored from the running totals of the table.
 
-        resulting_entropy = (m / n) * entropy(dfr1) + ((n - m) / n) * entropy(dfr2)
-        current_information_gain = input_entropy - resulting_entropy
+    Returns the value at which to split and the resulting information gain.
 
-        if current_information_gain > maximum_information_gain:
-            best_split = split
-            maximum_information_gain = current_information_gain
+    :param histogram: numpy array
+    :param edges: numpy array
+    :return: float, float
+    """
+    total_counts = histogram.sum(axis=0)
+    input_entropy = counts_entropy(total_counts)
+    if input_entropy == 0:
+        return None, 0
+
+    n = total_counts.sum()
+    left_counts = np.cumsum(histogram, axis=0)[:-1]
+    left_n = left_counts.sum(axis=1)
+    candidates = np.flatnonzero((left_n > 0) & (left_n < n))
+    if len(candidates) == 0:
+        return None, 0
+
+    left = left_counts[candidates]
+    resulting_entropy = (left_n[candidates] * counts_entropy(left) +
+                         (n - left_n[candidates]) * counts_entropy(total_counts - left)) / n
+    gains = input_entropy - resulting_entropy
+    best = np.argmax(gains)
+    if not gains[best] > 0:
+        return None, 0
+    return edges[candidates[best]].item(), float(gains[best])
+
+
+def sweep_categorical(codes, labels, number_levels, number_classes, partition=False):
+    """
+    Chooses the level of an integer-coded categorical feature whose one-vs-rest split gives maximum information
+    gain. Labels must be integer codes below number_classes. The class counts of every level are built in one
+    grouped pass, and every one-vs-rest split is scored from those totals.
+
+    If partition is True, the levels are instead sorted by their share of the most common class and every cut of
+    that ordering is scored, so the levels can be split into any two groups. The levels above the cut go right.
+    With two classes this finds the best possible partition.
+
+    Returns the chosen level code (or tuple of level codes for a partition) and the resulting information gain.
+
+    :param codes: numpy array
+    :param labels: numpy array
+    :param number_levels: int
+    :param number_classes: int
+    :param partition: boolean
+    :return: int, float
+    :return: tuple, float
+    """
+    histogram = np.bincount(codes * number_classes + labels,
+                            minlength=number_levels * number_classes).reshape(number_levels, number_classes)
+    return categorical_histogram_split(histogram, partition)
+
+
+def categorical_histogram_split(histogram, partition=False):
+    """
+    Chooses the best split of an integer-coded categorical feature from its (levels x classes) table of label
+    counts, which may be weighted. Splits are one level against the rest, or any two groups of levels if
+    partition is True, as in sweep_categorical.
+
+    Returns the chosen level code (or tuple of level codes for a partition) and the resulting information gain.
+
+    :param histogram: numpy array
+    :param partition: boolean
+    :return: int, float
+    :return: tuple, float
+    """
+    total_counts = histogram.sum(axis=0)
+    n = total_counts.sum()
+    input_entropy = counts_entropy(total_counts)
+    level_counts = histogram.sum(axis=1)
+    present = np.flatnonzero(level_counts)
+    if len(present) < 2:
+        return None, 0
+
+    if partition:
+        share = histogram[present, np.argmax(total_counts)] / level_counts[present]
+        present = present[np.argsort(share, kind="mergesort")]
+        in_counts = total_counts - np.cumsum(histogram[present], axis=0)[:-1]
+    else:
+        in_counts = histogram[present]
+    m = in_counts.sum(axis=1)
+
+    resulting_entropy = (m * counts_entropy(in_counts) + (n - m) * counts_entropy(total_counts - in_counts)) / n
+    information_gain = input_entropy - resulting_entropy
 
-    return best_split, maximum_information_gain, "numeric"
+    best = np.argmax(information_gain)
+    if not information_gain[best] > 0:
+        return None, 0
+    if partition:
+        return tuple(sorted(present[best + 1:].tolist())), float(information_gain[best])
+    return present[best].item(), float(information_gain[best])
 
 
 def categorical_splitter(data, feature):
@@ -112,24 +296,10 @@ def categorical_splitter(data, feature):
     :param feature: str
     :return: str, float
     """
-    input_entropy = entropy(data)
-    max_information_gain = 0
-    current_type = ""
-    groups = set(data[feature])
-    for group in groups:
-        n = len(data.index)
-        m = len(data[data[feature] == group].index)
-
-        dfr1 = data[data[feature] == group]
-        dfr2 = data[data[feature] != group]
-
-        resulting_entropy = (m / n) * entropy(dfr1) + ((n - m) / n) * entropy(dfr2)
-        information_gain = input_entropy - resulting_entropy
-
-        if information_gain > max_information_gain:
-            current_type = group
-            max_information_gain = information_gain
-
+    codes, groups = pd.factorize(data[feature])
+    labels, classes = pd.factorize(data["lbl"])
+    group, max_information_gain = sweep_categorical(codes, labels, len(groups), len(classes))
+    current_type = "" if group is None else groups[group]
     return current_type, max_information_gain, "categorical"
 
 
@@ -153,38 +323,420 @@ def splitter(data, feature):
         raise TypeError("'splitter' function requires a numeric or string type feature column as second arg")
 
 
-def best_split(input_data, random_subset=False):
+class DataMatrix:
+    """
+    A pandas data frame encoded once into one numpy array per column, so that trees can be built by passing row
+    indices around instead of copies of the data. A data matrix can be saved as a columnar dataset on disk and
+    memory-mapped back, so that it does not have to be parsed again.
+    """
+
+    def __init__(self, input_data, target="lbl"):
+        """
+        Encodes a data frame whose label column is named target. Every other column is a feature, in any order.
+        Numeric features are stored as they are, categorical features as integer codes into their sorted levels,
+        and the labels as integer codes into the sorted classes.
+
+        :param input_data: pandas data frame
+        :param target: str
+        """
+        self.label_column = target
+        self.path = None
+        self.features = [feature for feature in input_data.columns if feature != target]
+        self.n = len(input_data.index)
+        self.types = []
+        self.levels = []
+        self.columns = []
+        for feature in self.features:
+            column = input_data[feature]
+            if pd.api.types.is_string_dtype(column):
+                codes, levels = pd.factorize(column, sort=True)
+                self.types.append("categorical")
+                self.levels.append(np.asarray(levels, dtype=object))
+                self.columns.append(codes.astype(np.int64))
+            elif pd.api.types.is_numeric_dtype(column):
+                self.types.append("numeric")
+                self.levels.append(None)
+                self.columns.append(column.to_numpy(dtype=float))
+            else:
+                raise TypeError("Feature columns must be numeric or string type")
+        labels, classes = pd.factorize(input_data[target], sort=True)
+        self.labels = labels.astype(np.int64)
+        self.classes = np.asarray(classes, dtype=object)
+
+    @classmethod
+    def from_arrays(cls, features, types, levels, columns, labels, classes, label_column="lbl"):
+        """
+        Rebuilds a data matrix around arrays that are already encoded, for example views of shared memory in a
+        worker process. No data is copied.
+
+        :param features: list
+        :param types: list
+        :param levels: list
+        :param columns: list
+        :param labels: numpy array
+        :param classes: numpy array
+        :param label_column: str
+        :return: DataMatrix
+        """
+        data = cls.__new__(cls)
+        data.label_column = label_column
+        data.path = None
+        data.features = list(features)
+        data.types = list(types)
+        data.levels = list(levels)
+        data.columns = list(columns)
+        data.n = len(labels)
+        data.labels = labels
+        data.classes = classes
+        return data
+
+    def save(self, path):
+        """
+        Saves the data matrix as a columnar dataset: a directory holding one .npy file per feature, one for the
+        labels, and a metadata.json file with the features, their types and levels, the classes and the name of
+        the label column.
+
+        :param path: str
+        """
+        os.makedirs(path, exist_ok=True)
+        for j, column in enumerate(self.columns):
+            np.save(os.path.join(path, "feature_" + str(j) + ".npy"), column)
+        np.save(os.path.join(path, "labels.npy"), self.labels)
+        metadata = {"format": DATASET_FORMAT, "n": self.n, "label_column": self.label_column,
+                    "features": self.features, "types": self.types,
+                    "levels": [None if levels is None else json_values(levels) for levels in self.levels],
+                    "classes": json_values(self.classes)}
+        with open(os.path.join(path, "metadata.json"), "w") as file:
+            json.dump(metadata, file, indent=1)
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """
+        Loads a columnar dataset saved by DataMatrix.save. The columns are memory-mapped rather than read, so
+        loading is almost instant and processes that load the same dataset share its pages.
+
+        :param path: str
+        :param mmap_mode: str
+        :return: DataMatrix
+        """
+        with open(os.path.join(path, "metadata.json")) as file:
+            metadata = json.load(file)
+        if metadata.get("format") != DATASET_FORMAT:
+            raise ValueError("Unsupported dataset format: " + str(metadata.get("format")))
+        columns = [np.load(os.path.join(path, "feature_" + str(j) + ".npy"), mmap_mode=mmap_mode)
+                   for j in range(len(metadata["features"]))]
+        levels = [None if group is None else np.array(group, dtype=object) for group in metadata["levels"]]
+        data = cls.from_arrays(metadata["features"], metadata["types"], levels, columns,
+                               np.load(os.path.join(path, "labels.npy"), mmap_mode=mmap_mode),
+                               np.array(metadata["classes"], dtype=object), metadata["label_column"])
+        data.path = path
+        return data
+
+    def __str__(self):
+        """
+        Prints a short description of the data matrix.
+
+        :return: str
+        """
+        return "DataMatrix with '" + str(self.n) + "' rows, features " + str(self.features) + \
+               " and classes " + str(self.classes.tolist())
+
+    def pass_rows(self, rows, feature_type, feature, split):
+        """
+        Finds which of the given rows go right under a decision. Numeric points go right when they are above the
+        split, categorical points when they equal the split group, and partition points when they are one of the
+        split groups.
+
+        :param rows: numpy array
+        :param feature_type: str
+        :param feature: str
+        :param split: numeric or str
+        :return: numpy array
+        """
+        j = self.features.index(feature)
+        column = self.columns[j][rows]
+        if feature_type == "numeric":
+            return column > split
+        elif feature_type == "categorical":
+            level = np.searchsorted(self.levels[j], split)
+            return column == level
+        elif feature_type == "partition":
+            levels = np.searchsorted(self.levels[j], list(split))
+            return np.isin(column, levels)
+        raise TypeError("Something went horribly wrong")
+
+
+def split_column(data, j, rows, bins=None, partition=False):
+    """
+    Finds the best split of the given rows of an encoded data matrix on feature column j. If bins from bin_features
+    are given, numeric features are split on their bin codes. If partition is True, categorical features are split
+    into two groups of levels rather than one level against the rest.
+
+    Returns the split group or split point, the resulting information gain and the type of splitting variable.
+    :param data: DataMatrix
+    :param j: int
+    :param rows: numpy array
+    :param bins: dict
+    :param partition: boolean
+    :return: str, float, str
+    :return: tuple, float, str
+    :return: float, float, str
+    """
+    labels = data.labels[rows]
+    number_classes = len(data.classes)
+    if data.types[j] == "categorical":
+        levels = data.levels[j]
+        level, information_gain = sweep_categorical(data.columns[j][rows].astype(np.int64), labels, len(levels),
+                                                    number_classes, partition)
+        if level is None:
+            return "", information_gain, "categorical"
+        if partition:
+            return tuple(levels[list(level)]), information_gain, "partition"
+        return levels[level], information_gain, "categorical"
+    if bins and j in bins:
+        edges, codes = bins[j]
+        split, information_gain = binned_numeric(codes[rows], edges, labels, number_classes)
+    else:
+        split, information_gain = sweep_numeric(data.columns[j][rows], labels, number_classes)
+    return split, information_gain, "numeric"
+
+
+def best_split(input_data, random_subset=False, bins=None, rows=None, random_state=None, executor=None,
+               partition=False, considered=None):
     """
     Finds the feature that best splits the input data. If random subset is True, only consider a random
-    subset of features.
+    subset of features, drawn with random_state (a random.Random) if given. If bins from bin_features are given,
+    numeric features are split on their bin codes. If partition is True, categorical features are split into two
+    groups of levels. The input data can be a pandas data frame or a DataMatrix, in which case only the given rows
+    are considered.
+
+    If a thread pool executor is given, features of large nodes are scored concurrently. The highest information
+    gain wins either way, with ties going to the feature that comes first in column order. If a considered list is
+    given, the indices of the feature columns weighed are appended to it.
 
     Returns the best feature, its type, the associated information gain, and the split
-    :param input_data: pandas data frame
+    :param input_data: pandas data frame or DataMatrix
     :param random_subset: boolean
+    :param bins: dict
+    :param rows: numpy array
+    :param random_state: random.Random
+    :param executor: concurrent.futures.Executor
+    :param partition: boolean
+    :param considered: list
     :return: str, str, numeric, float
     :return: str, str, str, float
     """
     # TODO: just return None immediately if this function is passed trivial data
     # TODO: is it worth checking? Does the runtime get any better?
     # TODO: Repeat this behavior for the individual splitter functions as well - maybe at the aggregate level
+    if not isinstance(input_data, DataMatrix):
+        input_data = DataMatrix(input_data)
+    if rows is None:
+        rows = np.arange(input_data.n)
+    columns = list(range(len(input_data.features)))
     if random_subset:
-        features = input_data.columns.tolist()
-        del features[-1]
-        n = len(features)
-        selection = sample(features, floor(np.log2(n + 1)))
-        selection.append("lbl")
-        input_data = input_data[selection]
+        n = len(columns)
+        draw = random_state.sample if random_state is not None else sample
+        columns = sorted(draw(columns, floor(np.log2(n + 1))))
+    if considered is not None:
+        considered.extend(columns)
     best_feature = None
     feature_type = None
     maximum_information_gain = 0
     split = None
-    for feature in input_data.columns:
-        if feature == "lbl":
-            break
-        result = splitter(input_data, feature)
+    if executor is not None and len(columns) > 1 and len(rows) >= PARALLEL_MIN_ROWS:
+        results = list(executor.map(lambda column: split_column(input_data, column, rows, bins, partition),
+                                    columns))
+    else:
+        results = (split_column(input_data, column, rows, bins, partition) for column in columns)
+    for j, result in zip(columns, results):
         if result[1] > maximum_information_gain:
-            best_feature = feature
+            best_feature = input_data.features[j]
             feature_type = result[2]
             maximum_information_gain = result[1]
             split = result[0]
     return feature_type, best_feature, split, maximum_information_gain
+
+
+class ChunkedData:
+    """
+    A CSV or Parquet file that is read in chunks, so that trees can be trained on more rows than fit in memory.
+    """
+
+    def __init__(self, path, max_bins=255, chunksize=100000, target="lbl"):
+        """
+        Scans a file whose label column is named target once. Every other column is a feature, typed from the
+        first chunk. The scan collects the levels of every categorical feature, the classes, and a quantile
+        sketch of every numeric feature from which its bin edges are chosen.
+
+        :param path: str
+        :param max_bins: int
+        :param chunksize: int
+        :param target: str
+        """
+        if max_bins < 2:
+            raise ValueError("Binned split finding needs at least 2 bins")
+        self.label_column = target
+        self.path = path
+        self.chunksize = chunksize
+        self.features = None
+        self.n = 0
+        sketches, levels, classes = {}, {}, set()
+        for chunk in read_chunks(path, chunksize):
+            if self.features is None:
+                self.features = [feature for feature in chunk.columns if feature != target]
+                self.types = []
+                for j, feature in enumerate(self.features):
+                    if pd.api.types.is_string_dtype(chunk[feature]):
+                        self.types.append("categorical")
+                        levels[j] = set()
+                    elif pd.api.types.is_numeric_dtype(chunk[feature]):
+                        self.types.append("numeric")
+                        sketches[j] = QuantileSketch(max(8192, 32 * max_bins))
+                    else:
+                        raise TypeError("Feature columns must be numeric or string type")
+            for j, feature in enumerate(self.features):
+                if j in sketches:
+                    sketches[j].update(chunk[feature].to_numpy(dtype=float))
+                else:
+                    levels[j].update(chunk[feature].unique())
+            classes.update(chunk[target].unique())
+            self.n += len(chunk.index)
+        if self.features is None:
+            raise ValueError("Cannot train on an empty file")
+        self.levels = [np.array(sorted(levels[j]), dtype=object) if j in levels else None
+                       for j in range(len(self.features))]
+        self.classes = np.array(sorted(classes), dtype=object)
+        self.edges = {j: sketch.edges(max_bins) for j, sketch in sketches.items()}
+
+    def __str__(self):
+        """
+        Prints a short description of the chunked data.
+
+        :return: str
+        """
+        return "ChunkedData from '" + str(self.path) + "' with '" + str(self.n) + "' rows, features " + \
+               str(self.features) + " and classes " + str(self.classes.tolist())
+
+    def chunks(self):
+        """
+        Reads the file again one chunk at a time. Each chunk is encoded into a DataMatrix with the levels and
+        classes found by the scan, along with its bins in the form that bin_features gives.
+
+        :return: generator
+        """
+        for chunk in read_chunks(self.path, self.chunksize):
+            columns = []
+            bins = {}
+            for j, feature in enumerate(self.features):
+                if self.types[j] == "categorical":
+                    columns.append(pd.Categorical(chunk[feature], categories=self.levels[j]).codes.astype(np.int64))
+                else:
+                    columns.append(chunk[feature].to_numpy(dtype=float))
+                    bins[j] = self.edges[j], bin_codes(columns[j], self.edges[j])
+            labels = pd.Categorical(chunk[self.label_column], categories=self.classes).codes.astype(np.int64)
+            yield DataMatrix.from_arrays(self.features, self.types, self.levels, columns, labels, self.classes,
+                                         self.label_column), bins
+
+
+def column_histogram(data, j, rows, bins, weights=None):
+    """
+    Counts the labels of the given rows of an encoded data matrix in every bin (or level) of feature column j.
+    If weights are given, each row counts as many times as its weight.
+
+    Returns a (bins x classes) or (levels x classes) table of label counts.
+
+    :param data: DataMatrix
+    :param j: int
+    :param rows: numpy array
+    :param bins: dict
+    :param weights: numpy array
+    :return: numpy array
+    """
+    number_classes = len(data.classes)
+    if data.types[j] == "categorical":
+        codes = data.columns[j][rows].astype(np.int64)
+        number_bins = len(data.levels[j])
+    else:
+        edges, codes = bins[j]
+        codes = codes[rows].astype(np.int64)
+        number_bins = len(edges) + 1
+    histogram = np.bincount(codes * number_classes + data.labels[rows],
+                            weights=None if weights is None else weights[rows],
+                            minlength=number_bins * number_classes)
+    return histogram.reshape(number_bins, number_classes)
+
+
+def histogram_split(data, j, histogram, partition=False):
+    """
+    Finds the best split on feature column j of chunked data from a table of label counts made by column_histogram.
+
+    Returns the split group or split point, the resulting information gain and the type of splitting variable.
+    :param data: ChunkedData
+    :param j: int
+    :param histogram: numpy array
+    :param partition: boolean
+    :return: str, float, str
+    :return: tuple, float, str
+    :return: float, float, str
+    """
+    if data.types[j] == "categorical":
+        levels = data.levels[j]
+        level, information_gain = categorical_histogram_split(histogram, partition)
+        if level is None:
+            return "", information_gain, "categorical"
+        if partition:
+            return tuple(levels[list(level)]), information_gain, "partition"
+        return levels[level], information_gain, "categorical"
+    split, information_gain = numeric_histogram_split(histogram, data.edges[j])
+    return split, information_gain, "numeric"
+
+
+def best_histogram_split(data, histograms, partition=False):
+    """
+    Finds the feature that best splits a node of chunked data from its tables of label counts, given as a
+    dictionary from feature column index to the table made by column_histogram. The highest information gain wins,
+    with ties going to the feature that comes first in column order.
+
+    Returns the best feature, its type, the associated information gain, and the split
+    :param data: ChunkedData
+    :param histograms: dict
+    :param partition: boolean
+    :return: str, str, float or str or tuple, float
+    """
+    best_feature = None
+    feature_type = None
+    maximum_information_gain = 0
+    split = None
+    for j in sorted(histograms):
+        result = histogram_split(data, j, histograms[j], partition)
+        if result[1] > maximum_information_gain:
+            best_feature = data.features[j]
+            feature_type = result[2]
+            maximum_information_gain = result[1]
+            split = result[0]
+    return feature_type, best_feature, split, maximum_information_gain
+
+
+def histogram_sides(data, histogram, feature_type, feature, split):
+    """
+    Splits a node's table of label counts for the feature it is split on into the label counts of the rows going
+    left and the rows going right.
+
+    :param data: ChunkedData
+    :param histogram: numpy array
+    :param feature_type: str
+    :param feature: str
+    :param split: numeric or str
+    :return: numpy array, numpy array
+    """
+    j = data.features.index(feature)
+    if feature_type == "numeric":
+        right = np.arange(len(histogram)) > np.searchsorted(data.edges[j], split)
+    elif feature_type == "categorical":
+        right = data.levels[j] == split
+    elif feature_type == "partition":
+        right = np.isin(np.arange(len(histogram)), np.searchsorted(data.levels[j], list(split)))
+    else:
+        raise TypeError("Something went horribly wrong")
+    return histogram[~right].sum(axis=0), histogram[right].sum(axis=0)
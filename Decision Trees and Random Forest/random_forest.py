@@ -5,6 +5,112 @@ Implements random forest objects
 """
 
 import decision_tree as dt
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+# Each worker process keeps its view of the shared training data here
+worker_data = None
+worker_memory = []
+
+
+def bootstrap_rows(n, seed):
+    """
+    Draws the bootstrap sample of n rows, with repeats, that the tree grown from a seed (a numpy SeedSequence) is
+    trained on. The same seed always draws the same rows.
+
+    :param n: int
+    :param seed: numpy SeedSequence
+    :return: numpy array
+    """
+    return dt.fc.np.random.default_rng(seed.generate_state(2)[0]).integers(0, n, n)
+
+
+def grow_tree(data, seed, stats=None):
+    """
+    Grows one tree of a random forest on a bootstrap sample of the encoded data. The seed (a numpy SeedSequence)
+    decides both the bootstrap sample and the random feature subsets, so the same seed always grows the same tree.
+    If a functions.BuildStats is given, the tree is recorded in it.
+
+    :param data: DataMatrix
+    :param seed: numpy SeedSequence
+    :param stats: functions.BuildStats
+    :return: DecisionTree
+    """
+    feature_seed = seed.generate_state(2)[1]
+    return dt.DecisionTree(data, random_subset=True, rows=bootstrap_rows(data.n, seed), random_state=int(feature_seed),
+                           stats=stats)
+
+
+def share_array(array):
+    """
+    Copies a numpy array into a new block of shared memory. Returns the shared memory block and a description of
+    the array that worker processes can attach to.
+
+    :param array: numpy array
+    :return: SharedMemory, tuple
+    """
+    memory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    order = "F" if array.flags.f_contiguous and not array.flags.c_contiguous else "C"
+    view = dt.fc.np.ndarray(array.shape, dtype=array.dtype, buffer=memory.buf, order=order)
+    view[...] = array
+    return memory, (memory.name, array.shape, array.dtype.str, order)
+
+
+def attach_array(description):
+    """
+    Attaches to an array in shared memory made by share_array, without copying it.
+
+    :param description: tuple
+    :return: numpy array
+    """
+    name, shape, dtype, order = description
+    memory = shared_memory.SharedMemory(name=name)
+    # Keep the block open for as long as the worker lives
+    worker_memory.append(memory)
+    return dt.fc.np.ndarray(shape, dtype=dtype, buffer=memory.buf, order=order)
+
+
+def attach_worker(features, types, levels, columns, labels, classes):
+    """
+    Sets up a worker process with the forest's training data, read straight from shared memory.
+
+    :param features: list
+    :param types: list
+    :param levels: list
+    :param columns: list
+    :param labels: tuple
+    :param classes: numpy array
+    """
+    global worker_data
+    worker_data = dt.fc.DataMatrix.from_arrays(features, types, levels, [attach_array(column) for column in columns],
+                                               attach_array(labels), classes)
+
+
+def attach_dataset(path):
+    """
+    Sets up a worker process with the forest's training data by memory-mapping the dataset it was loaded from, so
+    that every worker shares the same pages.
+
+    :param path: str
+    """
+    global worker_data
+    worker_data = dt.fc.DataMatrix.load(path)
+
+
+def grow_worker_tree(seed, memory=None):
+    """
+    Grows one tree in a worker process set up by attach_worker. If memory is not None, the tree is recorded in a
+    new functions.BuildStats that traces memory if memory is True, which is returned with the tree.
+
+    :param seed: numpy SeedSequence
+    :param memory: boolean
+    :return: DecisionTree, or DecisionTree, functions.BuildStats
+    """
+    if memory is None:
+        return grow_tree(worker_data, seed)
+    stats = dt.fc.BuildStats(memory)
+    return grow_tree(worker_data, seed, stats), stats
 
 
 class RandomForest:
@@ -12,20 +118,179 @@ class RandomForest:
     A random forest
     """
 
-    def __init__(self, input_data, number_trees):
+    def __init__(self, input_data, number_trees, n_jobs=None, random_state=None, stats=None):
         """
         Creates a new random forest as a list of decision trees.
         Number of trees must be an odd positive integer.
 
-        :param input_data: pandas data frame
+        Every tree gets its own seed derived from random_state, which decides its bootstrap sample and its random
+        feature subsets. If n_jobs is more than 1 (or -1 for every core), the training data is put in shared memory
+        once and the trees are grown in that many processes. A DataMatrix loaded from a dataset on disk is instead
+        memory-mapped by every process, which then share its pages. The same random_state grows the same forest
+        either way.
+
+        Once the trees are grown, every training row is classified by the trees whose bootstrap sample left it
+        out, giving oob_prediction_ (None for a row that every tree saw) and their accuracy oob_score_, without a
+        held-out dataset. feature_importances_ gives each feature's share of the information gain of every split,
+        weighted by the rows reaching the split, as a pandas series.
+
+        If a functions.BuildStats is given as stats, every node and tree of the forest is recorded in it, in the
+        order of the trees, including trees grown in worker processes.
+
+        :param input_data: pandas data frame or DataMatrix
+        :param number_trees: int
+        :param n_jobs: int
+        :param random_state: int
+        :param stats: functions.BuildStats
+        """
+        if number_trees % 2 == 0 or number_trees <= 0:
+            raise ValueError("Number of trees must be an odd positive integer")
+        # Encode the data once; each tree only draws bootstrapped row indices into it
+        data = input_data if isinstance(input_data, dt.fc.DataMatrix) else dt.fc.DataMatrix(input_data)
+        self.classes = data.classes
+        self.compiled = None
+        seeds = dt.fc.np.random.SeedSequence(random_state).spawn(number_trees)
+        if n_jobs == -1:
+            n_jobs = os.cpu_count()
+        memory = None if stats is None else stats.memory
+        if not n_jobs or n_jobs == 1:
+            self.trees = [grow_tree(data, seed, stats) for seed in seeds]
+        elif data.path is not None:
+            with ProcessPoolExecutor(max_workers=n_jobs, initializer=attach_dataset,
+                                     initargs=(data.path,)) as executor:
+                self.trees = self.collect(executor.map(grow_worker_tree, seeds, [memory] * number_trees), stats)
+        else:
+            self.trees = self.grow_shared(data, seeds, n_jobs, stats)
+        self.set_feature_importances(data.features)
+
+        # Every tree votes on the rows its bootstrap sample left out
+        trees = self.compile()
+        matrix = trees[0].encode_data(data)
+        votes = dt.fc.np.zeros((data.n, len(self.classes)), dtype=dt.fc.np.int64)
+        for tree, seed in zip(trees, seeds):
+            out_of_bag = dt.fc.np.ones(data.n, dtype=bool)
+            out_of_bag[bootstrap_rows(data.n, seed)] = False
+            rows = dt.fc.np.flatnonzero(out_of_bag)
+            votes[rows, tree.value[tree.apply(matrix[rows])]] += 1
+        self.set_out_of_bag(votes, data.labels)
+
+    @staticmethod
+    def collect(results, stats):
+        """
+        Gathers the trees grown by grow_worker_tree, adding the records of each one to stats if it is given.
+
+        :param results: iterable
+        :param stats: functions.BuildStats
+        :return: list
+        """
+        if stats is None:
+            return list(results)
+        trees = []
+        for tree, tree_stats in results:
+            trees.append(tree)
+            stats.merge(tree_stats)
+        return trees
+
+    @staticmethod
+    def grow_shared(data, seeds, n_jobs, stats=None):
+        """
+        Grows a tree for every seed in n_jobs processes, which read the training data from shared memory. If a
+        functions.BuildStats is given, the trees are recorded in it.
+
+        :param data: DataMatrix
+        :param seeds: list
+        :param n_jobs: int
+        :param stats: functions.BuildStats
+        :return: list
+        """
+        memory = None if stats is None else stats.memory
+        blocks, columns = [], []
+        try:
+            for column in data.columns:
+                block, description = share_array(column)
+                blocks.append(block)
+                columns.append(description)
+            block, labels = share_array(data.labels)
+            blocks.append(block)
+            with ProcessPoolExecutor(max_workers=n_jobs, initializer=attach_worker,
+                                     initargs=(data.features, data.types, data.levels, columns, labels,
+                                               data.classes)) as executor:
+                return RandomForest.collect(executor.map(grow_worker_tree, seeds, [memory] * len(seeds)), stats)
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+    @classmethod
+    def from_chunks(cls, source, number_trees, max_bins=255, chunksize=100000, random_state=None):
+        """
+        Creates a new random forest from a CSV or Parquet file too large to load, reading it in chunks. Every tree
+        is grown as by DecisionTree.from_chunks, and all the trees are grown together, so each level of the forest
+        takes one read of the file. Instead of drawing a bootstrap sample, every row of every chunk is counted a
+        Poisson(1) number of times in each tree, drawn from the tree's seed. The same random_state grows the same
+        forest. One more read of the file lets every tree vote on the rows it counted zero times, for
+        oob_prediction_ and oob_score_.
+
+        :param source: str or functions.ChunkedData
         :param number_trees: int
+        :param max_bins: int
+        :param chunksize: int
+        :param random_state: int
+        :return: RandomForest
         """
         if number_trees % 2 == 0 or number_trees <= 0:
             raise ValueError("Number of trees must be an odd positive integer")
-        self.trees = []
-        for i in range(0, number_trees):
-            bootstrapped_data = input_data.sample(max(input_data.count()), replace=True)
-            self.trees.append(dt.DecisionTree(bootstrapped_data, random_subset=True))
+        if not isinstance(source, dt.fc.ChunkedData):
+            source = dt.fc.ChunkedData(source, max_bins, chunksize)
+        forest = cls.__new__(cls)
+        forest.classes = source.classes
+        forest.compiled = None
+        seeds = [seed.generate_state(2) for seed in dt.fc.np.random.SeedSequence(random_state).spawn(number_trees)]
+        forest.trees = dt.grow_chunked(source, [int(seed[0]) for seed in seeds], random_subset=True,
+                                       random_states=[int(seed[1]) for seed in seeds])
+        forest.set_feature_importances(source.features)
+
+        trees = forest.compile()
+        votes, labels = [], []
+        for c, (matrix, _) in enumerate(source.chunks()):
+            encoded = trees[0].encode_data(matrix)
+            chunk_votes = dt.fc.np.zeros((matrix.n, len(forest.classes)), dtype=dt.fc.np.int64)
+            for tree, seed in zip(trees, seeds):
+                weights = dt.fc.np.random.default_rng([int(seed[0]), c]).poisson(1.0, matrix.n)
+                rows = dt.fc.np.flatnonzero(weights == 0)
+                chunk_votes[rows, tree.value[tree.apply(encoded[rows])]] += 1
+            votes.append(chunk_votes)
+            labels.append(matrix.labels)
+        forest.set_out_of_bag(dt.fc.np.concatenate(votes), dt.fc.np.concatenate(labels))
+        return forest
+
+    def set_feature_importances(self, features):
+        """
+        Adds up the weighted information gain of every split in every tree for each feature, and sets
+        feature_importances_ to each feature's share of the total.
+
+        :param features: list
+        """
+        gains = dt.fc.pd.Series(0.0, index=features)
+        for tree in self.trees:
+            for feature, gain in tree.feature_gains().items():
+                gains.loc[feature] += gain
+        total = gains.sum()
+        self.feature_importances_ = gains / total if total > 0 else gains
+
+    def set_out_of_bag(self, votes, labels):
+        """
+        Sets oob_prediction_ and oob_score_ from a (rows x classes) matrix of the votes each training row got from
+        the trees that left it out, with ties going to the class that comes first in sorted order.
+
+        :param votes: numpy array
+        :param labels: numpy array
+        """
+        scored = votes.sum(axis=1) > 0
+        predicted = dt.fc.np.argmax(votes[scored], axis=1)
+        self.oob_prediction_ = dt.fc.np.full(len(votes), None, dtype=object)
+        self.oob_prediction_[scored] = self.classes[predicted]
+        self.oob_score_ = float(dt.fc.np.mean(predicted == labels[scored])) if scored.any() else None
 
     def __str__(self):
         """
@@ -56,20 +321,118 @@ class RandomForest:
         # Should show the total vote from each tree
         pass
 
+    def compile(self):
+        """
+        Compiles every tree in the forest so that they all read the same encoded feature matrix and give their
+        votes as indices into the forest's classes. The result is cached, so the forest is only compiled once.
+
+        :return: list
+        """
+        if self.compiled is None:
+            self.compiled = dt.merge_compiled([tree.compile() for tree in self.trees], self.classes)
+        return self.compiled
+
+    def save(self, path):
+        """
+        Saves the compiled forest to one binary model file that RandomForest.load can memory-map. Only the trees'
+        structure, the out-of-bag score and the feature importances are written, never the training data.
+
+        :param path: str
+        """
+        dt.tc.save_compiled(path, "RandomForest", self.compile(),
+                            {"oob_score": self.oob_score_,
+                             "features": dt.tc.json_values(self.feature_importances_.index),
+                             "feature_importances": self.feature_importances_.tolist()}, self.classes)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a random forest saved by RandomForest.save. The file is memory-mapped and every tree is a view of it,
+        so loading takes milliseconds even for large forests and processes that load the same file share its
+        pages. The loaded forest has no DecisionTree objects, so it classifies with its compiled trees.
+
+        :param path: str
+        :return: RandomForest
+        """
+        forest = cls.__new__(cls)
+        header, forest.compiled = dt.load_compiled(path, "RandomForest")
+        forest.classes = dt.fc.np.array(header["classes"], dtype=object)
+        forest.trees = None
+        forest.oob_score_ = header["extra"].get("oob_score")
+        forest.oob_prediction_ = None
+        forest.feature_importances_ = dt.fc.pd.Series(header["extra"].get("feature_importances", []),
+                                                      index=header["extra"].get("features", []), dtype=float)
+        return forest
+
+    def vote_counts(self, frame, n_jobs=1):
+        """
+        Collects every tree's vote for every row of a pandas data frame into a (trees x rows) matrix of class
+        indices, then counts the votes for each class. If n_jobs is more than 1, trees are scored concurrently in
+        that many threads.
+
+        Returns a (rows x classes) matrix of vote counts, with columns in the order of the forest's classes.
+
+        :param frame: pandas data frame
+        :param n_jobs: int
+        :return: numpy array
+        """
+        trees = self.compile()
+        matrix = trees[0].encode(frame)
+
+        def vote(tree):
+            return tree.value[tree.apply(matrix)]
+
+        if n_jobs and n_jobs > 1:
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                votes = dt.fc.np.array(list(executor.map(vote, trees)))
+        else:
+            votes = dt.fc.np.array([vote(tree) for tree in trees])
+        number_rows = votes.shape[1]
+        number_classes = len(self.classes)
+        offsets = dt.fc.np.arange(number_rows) * number_classes
+        counts = dt.fc.np.bincount((votes + offsets).ravel(), minlength=number_rows * number_classes)
+        return counts.reshape(number_rows, number_classes)
+
+    def classify_frame(self, frame, n_jobs=1):
+        """
+        Classifies every row of a pandas data frame with a vote from each tree. Ties go to the class that comes
+        first in sorted order. If n_jobs is more than 1, trees are scored concurrently in that many threads.
+
+        :param frame: pandas data frame
+        :param n_jobs: int
+        :return: numpy array
+        """
+        return self.classes[dt.fc.np.argmax(self.vote_counts(frame, n_jobs), axis=1)]
+
+    def predict_proba(self, frame, n_jobs=1):
+        """
+        Gives the share of trees voting for each class, for every row of a pandas data frame. If n_jobs is more
+        than 1, trees are scored concurrently in that many threads.
+
+        :param frame: pandas data frame
+        :param n_jobs: int
+        :return: pandas data frame
+        """
+        probabilities = self.vote_counts(frame, n_jobs) / len(self.compile())
+        return dt.fc.pd.DataFrame(probabilities, index=frame.index, columns=self.classes)
+
     def classify_point(self, datapoint):
         """
-        Classifies a data point with the random forest. Decision based on a vote from each tree.
+        Classifies a data point with the random forest. Decision based on a vote from each tree, with ties going to
+        the class that comes first in sorted order.
         Data point should be a pandas data frame with a single row.
 
         :param datapoint:
         :return: str
         """
+        if self.trees is None:
+            return self.classify_frame(datapoint)[0]
         votes = []
         for tree in self.trees:
             votes.append(tree.classify_point(datapoint))
         max_count = 0
         max_item = None
-        items = set(votes)
+        items = sorted(set(votes))
         for item in items:
             count = votes.count(item)
             if count > max_count:
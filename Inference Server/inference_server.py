@@ -0,0 +1,397 @@
+"""
+Implements a local inference server that scores single-row requests to a saved model in micro-batches. It serves
+the models of both tree packages: the model file names its kind of model, which picks the package that loads it
+
+@author: Artem Naida
+"""
+
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import sys
+import time
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Model files are read with the code both tree packages share
+COMMON = os.path.join(ROOT, "Decision Trees Common")
+if COMMON not in sys.path:
+    sys.path.append(COMMON)
+from tree_common import json_values, read_model_header
+
+PACKAGES = {
+    "forest": os.path.join(ROOT, "Decision Trees and Random Forest"),
+    "boost": os.path.join(ROOT, "Decision Trees and Gradient Boost"),
+}
+# The package, module and class that load each kind of model saved by save_compiled in tree_common.py
+MODELS = {
+    "RandomForest": ("forest", "random_forest", "RandomForest"),
+    "DecisionTree": ("forest", "decision_tree", "DecisionTree"),
+    "GradientBoost": ("boost", "gradient_boost", "GradientBoost"),
+    "DecisionTreeReg": ("boost", "decision_tree", "DecisionTreeReg"),
+}
+
+
+def import_package(package, module):
+    """
+    Imports a module of one of the tree packages. Both packages have modules named functions and decision_tree,
+    so a process can only use one of them; importing from the other raises a ValueError.
+
+    :param package: str, "forest" or "boost"
+    :param module: str
+    :return: module
+    """
+    directory = PACKAGES[package]
+    loaded = sys.modules.get("decision_tree")
+    if loaded is not None and os.path.dirname(os.path.abspath(loaded.__file__)) != directory:
+        raise ValueError("This process already uses the other tree package, start a new one to use " + package)
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+    return importlib.import_module(module)
+
+
+def model_kind(path):
+    """
+    Reads the kind of model a model file holds, such as "RandomForest", from its header.
+
+    :param path: str
+    :return: str
+    """
+    return read_model_header(path)[0]["model"]
+
+
+def load_model(path):
+    """
+    Loads a model file saved by the save method of RandomForest, DecisionTree, GradientBoost or DecisionTreeReg.
+
+    :param path: str
+    :return: model
+    """
+    kind = model_kind(path)
+    if kind not in MODELS:
+        raise ValueError("Unknown kind of model: " + kind)
+    package, module, name = MODELS[kind]
+    return getattr(import_package(package, module), name).load(path)
+
+
+def batch_scorer(model):
+    """
+    Gives the method that scores a data frame of rows with a model: classify_frame for a classifier,
+    predict_frame for a regressor.
+
+    :param model: model
+    :return: callable
+    """
+    return model.classify_frame if hasattr(model, "classify_frame") else model.predict_frame
+
+
+def percentile(values, q):
+    """
+    Gives the q-th percentile of a sequence of numbers, or None if it is empty.
+
+    :param values: sequence
+    :param q: float
+    :return: float
+    """
+    if not values:
+        return None
+    return float(np.percentile(np.fromiter(values, dtype=float), q))
+
+
+class BatchMetrics:
+    """
+    Counts the requests and batches an inference server has scored and keeps the latencies and sizes of the most
+    recent ones, so that percentiles describe the current load rather than the whole life of the server.
+    """
+
+    def __init__(self, history=10000):
+        """
+        :param history: int, the number of recent requests and batches to keep
+        """
+        self.started = time.perf_counter()
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.latencies = deque(maxlen=history)
+        self.batch_sizes = deque(maxlen=history)
+        self.batch_times = deque(maxlen=history)
+
+    def record_batch(self, size, seconds):
+        """
+        Records a scored batch of some number of rows and the time it took to score it.
+
+        :param size: int
+        :param seconds: float
+        """
+        self.batches += 1
+        self.batch_sizes.append(size)
+        self.batch_times.append(seconds)
+
+    def record_request(self, seconds, failed=False):
+        """
+        Records the time a request waited from arriving at the batcher to getting its prediction.
+
+        :param seconds: float
+        :param failed: bool
+        """
+        self.requests += 1
+        self.errors += failed
+        self.latencies.append(seconds)
+
+    def summary(self):
+        """
+        Summarizes the metrics as a dictionary that can be written as JSON. Latencies are in milliseconds.
+
+        :return: dict
+        """
+        latencies = [1000 * seconds for seconds in self.latencies]
+        return {
+            "uptime_s": time.perf_counter() - self.started,
+            "requests": self.requests,
+            "errors": self.errors,
+            "batches": self.batches,
+            "mean_batch_size": sum(self.batch_sizes) / len(self.batch_sizes) if self.batch_sizes else None,
+            "max_batch_size": max(self.batch_sizes, default=None),
+            "mean_batch_ms": 1000 * sum(self.batch_times) / len(self.batch_times) if self.batch_times else None,
+            "latency_p50_ms": percentile(latencies, 50),
+            "latency_p90_ms": percentile(latencies, 90),
+            "latency_p99_ms": percentile(latencies, 99),
+            "latency_max_ms": max(latencies, default=None),
+        }
+
+
+class InferenceServer:
+    """
+    Serves predictions from a function that scores a data frame of rows at once, such as a model's
+    classify_frame or predict_frame. Single-row requests are gathered for a short window, or until enough rows
+    arrive, then scored together as one data frame, so that the cost of a prediction is spread over the whole
+    batch. Predictions are served as JSON over HTTP, on a TCP port or a Unix socket:
+    POST /predict with a JSON object of feature values returns {"prediction": value}
+    GET /metrics returns the batch size and latency metrics
+    """
+
+    def __init__(self, score_frame, features, window=0.002, max_batch=256, history=10000):
+        """
+        :param score_frame: callable, takes a pandas data frame and returns one prediction per row
+        :param features: list, the features every request must give, in the order of the frame's columns
+        :param window: float, the longest time in seconds the first row of a batch waits for others
+        :param max_batch: int, the number of rows that closes a batch before its window ends
+        :param history: int, the number of recent requests and batches the metrics keep
+        """
+        self.score_frame = score_frame
+        self.features = list(features)
+        self.window = window
+        self.max_batch = max_batch
+        self.metrics = BatchMetrics(history)
+        self.pending = []
+        self.ready = None
+        self.full = None
+        self.batcher = None
+
+    def __str__(self):
+        return "An inference server batching up to " + str(self.max_batch) + " rows every " \
+               + str(1000 * self.window) + " ms"
+
+    @classmethod
+    def for_model(cls, model, window=0.002, max_batch=256, history=10000):
+        """
+        Creates a server for a model of either tree package, scoring with its compiled trees.
+
+        :param model: RandomForest, DecisionTree, GradientBoost or DecisionTreeReg
+        :param window: float
+        :param max_batch: int
+        :param history: int
+        :return: InferenceServer
+        """
+        compiled = model.compile()
+        features = (compiled[0] if isinstance(compiled, list) else compiled).features
+        return cls(batch_scorer(model), features, window, max_batch, history)
+
+    def score(self, rows):
+        """
+        Scores a batch of rows, each a dictionary of feature values, as one data frame.
+
+        :param rows: list
+        :return: list
+        """
+        return json_values(self.score_frame(pd.DataFrame(rows, columns=self.features)))
+
+    def score_each(self, rows):
+        """
+        Scores rows one at a time. A row that cannot be scored gets the exception it raised instead of a prediction.
+
+        :param rows: list
+        :return: list
+        """
+        predictions = []
+        for row in rows:
+            try:
+                predictions.append(self.score([row])[0])
+            except Exception as error:
+                predictions.append(error)
+        return predictions
+
+    async def predict(self, row):
+        """
+        Queues a row for the next batch and waits for its prediction. Raises a ValueError if the row is missing
+        a feature the model splits on.
+
+        :param row: dict
+        :return: prediction
+        """
+        missing = [feature for feature in self.features if feature not in row]
+        if missing:
+            raise ValueError("Missing features: " + ", ".join(str(feature) for feature in missing))
+        if self.batcher is None:
+            self.start()
+        result = asyncio.get_running_loop().create_future()
+        self.pending.append((row, result, time.perf_counter()))
+        self.ready.set()
+        if len(self.pending) >= self.max_batch:
+            self.full.set()
+        return await result
+
+    def start(self):
+        """
+        Starts the task that closes and scores batches. Called by the first request if not called before.
+        """
+        self.ready = asyncio.Event()
+        self.full = asyncio.Event()
+        self.batcher = asyncio.get_running_loop().create_task(self.run_batches())
+
+    async def run_batches(self):
+        """
+        Closes a batch when its window ends or it holds max_batch rows, then scores it in a worker thread so that
+        the next batch keeps filling while this one is scored.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.ready.wait()
+            if len(self.pending) < self.max_batch:
+                try:
+                    await asyncio.wait_for(self.full.wait(), self.window)
+                except asyncio.TimeoutError:
+                    pass
+            batch, self.pending = self.pending[:self.max_batch], self.pending[self.max_batch:]
+            if not self.pending:
+                self.ready.clear()
+            if len(self.pending) < self.max_batch:
+                self.full.clear()
+
+            rows = [row for row, _, _ in batch]
+            start = time.perf_counter()
+            try:
+                predictions = await loop.run_in_executor(None, self.score, rows)
+            except Exception:
+                # Score the rows one at a time so that a bad row only fails its own request
+                predictions = await loop.run_in_executor(None, self.score_each, rows)
+            finished = time.perf_counter()
+            self.metrics.record_batch(len(batch), finished - start)
+            for (_, result, arrived), prediction in zip(batch, predictions):
+                failed = isinstance(prediction, Exception)
+                self.metrics.record_request(finished - arrived, failed)
+                if result.done():
+                    continue
+                if failed:
+                    result.set_exception(prediction)
+                else:
+                    result.set_result(prediction)
+
+    async def respond(self, method, target, body):
+        """
+        Answers one HTTP request. Returns the status code and the JSON payload of the response.
+
+        :param method: str
+        :param target: str
+        :param body: bytes
+        :return: int, dict
+        """
+        if method == "POST" and target == "/predict":
+            try:
+                row = json.loads(body)
+                if not isinstance(row, dict):
+                    raise ValueError("Expected a JSON object of feature values")
+                return 200, {"prediction": await self.predict(row)}
+            except ValueError as error:
+                return 400, {"error": str(error)}
+            except Exception as error:
+                return 500, {"error": str(error)}
+        if method == "GET" and target == "/metrics":
+            return 200, self.metrics.summary()
+        return 404, {"error": "Unknown endpoint " + method + " " + target}
+
+    async def handle(self, reader, writer):
+        """
+        Serves the HTTP requests of one connection, keeping it open until the client closes it or asks to.
+
+        :param reader: asyncio StreamReader
+        :param writer: asyncio StreamWriter
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target = request_line.decode("latin-1").split()[:2]
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                status, payload = await self.respond(method, target, body)
+                content = json.dumps(payload).encode("utf-8")
+                writer.write(b"HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n"
+                             % (status, HTTP_REASONS[status], len(content)) + content)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8000, path=None):
+        """
+        Starts listening on a TCP port, or on a Unix socket if a path is given, and returns the asyncio server.
+
+        :param host: str
+        :param port: int
+        :param path: str
+        :return: asyncio Server
+        """
+        if self.batcher is None:
+            self.start()
+        if path is not None:
+            return await asyncio.start_unix_server(self.handle, path)
+        return await asyncio.start_server(self.handle, host, port)
+
+
+HTTP_REASONS = {200: b"OK", 400: b"Bad Request", 404: b"Not Found", 500: b"Internal Server Error"}
+
+
+async def main(arguments):
+    server = InferenceServer.for_model(load_model(arguments.model), arguments.window_ms / 1000, arguments.max_batch)
+    listener = await server.serve(arguments.host, arguments.port, arguments.unix)
+    print(str(server) + ", listening on " + (arguments.unix or arguments.host + ":" + str(arguments.port)))
+    async with listener:
+        await listener.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve predictions from a saved tree model of either package")
+    parser.add_argument("model", help="a model file saved by RandomForest, DecisionTree, GradientBoost or "
+                                      "DecisionTreeReg.save")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--unix", default=None, help="serve on this Unix socket instead of a TCP port")
+    parser.add_argument("--window-ms", type=float, default=2.0, help="longest wait to fill a batch")
+    parser.add_argument("--max-batch", type=int, default=256, help="rows that close a batch early")
+    asyncio.run(main(parser.parse_args()))
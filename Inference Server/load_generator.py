@@ -0,0 +1,154 @@
+"""
+Generates load against a local inference server, to compare scoring requests one at a time with micro-batching
+
+@author: Artem Naida
+"""
+
+import inference_server as srv
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+
+def make_data(n, package, seed=0):
+    """
+    Makes a data frame of n rows with two numeric features, one categorical feature and a column to learn that
+    depends on all three: a label named "lbl" for the forest package, or a target named "tg" for the boost package.
+
+    :param n: int
+    :param package: str, "forest" or "boost"
+    :param seed: int
+    :return: pandas data frame
+    """
+    rng = np.random.default_rng(seed)
+    frame = pd.DataFrame({"x1": rng.normal(size=n), "x2": rng.uniform(0, 10, size=n),
+                          "colour": rng.choice(["red", "green", "blue"], size=n)})
+    if package == "forest":
+        score = frame["x1"] + 0.3 * frame["x2"] + (frame["colour"] == "red") + rng.normal(scale=0.5, size=n)
+        frame["lbl"] = np.where(score > 2, "high", np.where(score > 1, "medium", "low"))
+    else:
+        frame["tg"] = frame["x1"] + np.sin(frame["x2"]) + (frame["colour"] == "red") + rng.normal(scale=0.5, size=n)
+    return frame
+
+
+def train_model(package, data, trees, leaves):
+    """
+    Trains a random forest (trees must then be odd) or a gradient boost model of trees with some number of leaves.
+
+    :param package: str, "forest" or "boost"
+    :param data: pandas data frame
+    :param trees: int
+    :param leaves: int
+    :return: RandomForest or GradientBoost
+    """
+    if package == "forest":
+        return srv.import_package("forest", "random_forest").RandomForest(data, trees, random_state=0)
+    return srv.import_package("boost", "gradient_boost").GradientBoost(data, 0.1, trees, leaves)
+
+
+async def send_requests(host, port, bodies, latencies):
+    """
+    Sends prediction requests one after another over one keep-alive connection and records the latency of each.
+
+    :param host: str
+    :param port: int
+    :param bodies: list, the JSON bodies of the requests
+    :param latencies: list, the latencies in seconds are appended here
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    for body in bodies:
+        start = time.perf_counter()
+        writer.write(b"POST /predict HTTP/1.1\r\nHost: %s\r\nContent-Type: application/json\r\nContent-Length: %d"
+                     b"\r\n\r\n" % (host.encode("latin-1"), len(body)) + body)
+        await writer.drain()
+        status = (await reader.readline()).split()[1]
+        length = 0
+        while True:
+            line = await reader.readline()
+            if not line.strip():
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            if name.strip().lower() == "content-length":
+                length = int(value)
+        response = await reader.readexactly(length)
+        if status != b"200":
+            raise RuntimeError("Request failed with " + response.decode("utf-8"))
+        latencies.append(time.perf_counter() - start)
+    writer.close()
+
+
+async def run_load(model, rows, window, max_batch, connections):
+    """
+    Serves a model on a free local port and sends it every row as its own request, from some number of
+    connections at once. Returns the throughput, the latencies seen by the clients and the server's metrics.
+
+    :param model: RandomForest, DecisionTree, GradientBoost or DecisionTreeReg
+    :param rows: list, one dictionary of feature values per request
+    :param window: float
+    :param max_batch: int
+    :param connections: int
+    :return: dict
+    """
+    server = srv.InferenceServer.for_model(model, window, max_batch)
+    listener = await server.serve("127.0.0.1", 0)
+    port = listener.sockets[0].getsockname()[1]
+    bodies = [json.dumps(row).encode("utf-8") for row in rows]
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*(send_requests("127.0.0.1", port, bodies[c::connections], latencies)
+                           for c in range(connections)))
+    seconds = time.perf_counter() - start
+    listener.close()
+    await listener.wait_closed()
+    server.batcher.cancel()
+    metrics = server.metrics.summary()
+    return {"window_ms": 1000 * window, "max_batch": max_batch, "requests": len(rows),
+            "requests_per_s": len(rows) / seconds, "mean_batch_size": metrics["mean_batch_size"],
+            "client_p50_ms": 1000 * srv.percentile(latencies, 50),
+            "client_p99_ms": 1000 * srv.percentile(latencies, 99),
+            "server_p99_ms": metrics["latency_p99_ms"]}
+
+
+def main(arguments):
+    trees = arguments.trees or (51 if arguments.package == "forest" else 100)
+    model = train_model(arguments.package, make_data(arguments.train_rows, arguments.package), trees,
+                        arguments.leaves)
+    path = os.path.join(tempfile.mkdtemp(), arguments.package + ".model")
+    model.save(path)
+    model = srv.load_model(path)
+    rows = make_data(arguments.requests, arguments.package, seed=1).drop(columns=["lbl", "tg"], errors="ignore")
+    rows = rows.to_dict("records")
+
+    # The model's own single-row method, classify_point or predict_point
+    score_point = model.classify_point if hasattr(model, "classify_point") else model.predict_point
+    start = time.perf_counter()
+    for row in rows[:200]:
+        score_point(pd.DataFrame([row]))
+    print(score_point.__name__ + " in a loop: " + str(round(200 / (time.perf_counter() - start))) + " rows/s")
+
+    results = [asyncio.run(run_load(model, rows, 0.0, 1, arguments.connections)),
+               asyncio.run(run_load(model, rows, arguments.window_ms / 1000, arguments.max_batch,
+                                    arguments.connections))]
+    print(pd.DataFrame(results).round(3).to_string(index=False))
+    print("Batching raised throughput " + str(round(results[1]["requests_per_s"] / results[0]["requests_per_s"], 1))
+          + " times")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare unbatched and micro-batched scoring on a local server")
+    parser.add_argument("--package", choices=sorted(srv.PACKAGES), default="forest",
+                        help="serve a random forest or a gradient boost model")
+    parser.add_argument("--train-rows", type=int, default=5000)
+    parser.add_argument("--trees", type=int, default=None, help="51 for a forest and 100 for gradient boost")
+    parser.add_argument("--leaves", type=int, default=16, help="leaves per gradient boost tree")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--connections", type=int, default=256)
+    parser.add_argument("--window-ms", type=float, default=2.0)
+    parser.add_argument("--max-batch", type=int, default=256)
+    main(parser.parse_args())
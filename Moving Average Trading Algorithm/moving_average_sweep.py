@@ -0,0 +1,200 @@
+"""
+Implements the vectorized moving average engine and the parameter sweeps built on it. They live in a module with a
+plain name, not in Moving Average Trader.py, so the sweep's process pool workers can import them by name under the
+spawn start method as well as fork
+
+@author: Artem Naida
+"""
+
+from itertools import product
+from concurrent.futures import ProcessPoolExecutor
+import os
+import numpy as np
+import pandas as pd
+
+
+# Running totals of the prices: prefix[i] is the sum of prices[0..i-1], added up in the same order as the scalar
+# engine's. A (dates x tickers) panel gets running totals down each column
+def price_prefix_sums(prices):
+    prefix = np.zeros((len(prices) + 1,) + np.shape(prices)[1:])
+    np.cumsum(prices, axis=0, out=prefix[1:])
+    return prefix
+
+
+# Long (expanding) average minus short (rolling, short_time + 1 prices) average for every date from start on, or
+# up to stop, of one series or of every column of a panel
+def moving_average_spread(prefix, short_time, start=10, stop=None):
+    window = short_time + 1
+    stop = len(prefix) - 1 if stop is None else stop
+    totals = prefix[start + 1:stop + 1]
+    counts = np.arange(start + 1, stop + 1, dtype=float).reshape((-1,) + (1,) * (prefix.ndim - 1))
+    long_average = totals / counts
+    short_average = totals - prefix[start + 1 - window:stop + 1 - window]
+    short_average /= window
+    return np.subtract(long_average, short_average, out=long_average)
+
+
+# Trades signalled from start on: the dates, their prices, and whether each is a buy (long average above the short
+# one) or a sell. short - long is exactly -(long - short), so one spread serves both rules
+def moving_average_signals(prices, short_time, over_spread, under_spread, start=10):
+    prices = np.asarray(prices, dtype=float)
+    spread = moving_average_spread(price_prefix_sums(prices), short_time, start)
+    dates = np.flatnonzero((spread >= under_spread) | (spread <= -over_spread))
+    buys = spread[dates] > 0
+    dates += start
+    return dates, prices[dates], buys
+
+
+# Runs the cash accounting over a list of trades and returns the capital left and which buys went through. Sells
+# always go through; a buy only goes through if the capital covers the price. Runs of trades that all go through
+# are settled with one cumulative sum, and runs of buys that cannot be afforded are skipped in one search, so the
+# loop only turns over when the capital crosses a price. Cumulative sums add in order, so the capital matches
+# trading one date at a time exactly
+def fill_trades(prices, buys, cap, width=64):
+    i = 0
+    n = len(prices)
+    bought = np.zeros(n, dtype=bool)
+    while i < n:
+        end = min(i + width, n)
+        deltas = np.where(buys[i:end], -prices[i:end], prices[i:end])
+        running = np.cumsum(np.concatenate(([cap], deltas)))
+        failed = buys[i:end] & (running[:-1] < prices[i:end])
+        if not failed.any():
+            bought[i:end] = buys[i:end]
+            cap = running[-1]
+            i = end
+            width *= 2
+            continue
+        k = int(np.argmax(failed))
+        bought[i:i + k] = buys[i:i + k]
+        cap = running[k]
+        i += k
+        width = 64
+        # The capital stays put until the next sell or affordable buy
+        while i < n:
+            end = min(i + width, n)
+            stop = np.flatnonzero(~buys[i:end] | (prices[i:end] <= cap))
+            if len(stop):
+                i += int(stop[0])
+                break
+            i = end
+            width *= 2
+        width = 64
+    return float(cap), bought
+
+
+# Capital and number of stocks held after a list of trades
+def settle_trades(prices, buys, cap, stock_number, width=64):
+    cap, bought = fill_trades(prices, buys, cap, width)
+    return cap, stock_number + int(bought.sum()) - int((~np.asarray(buys, dtype=bool)).sum())
+
+
+# Settles a chunk of dates' trades for many portfolios at once, one per column of trading, updating the capital and
+# the stocks bought and sold of each in place. Prices and buys have one column per portfolio or one shared by all.
+# Only whether a buy is affordable depends on the dates before, so sells are added as they are, dates with no buys
+# skip the check, and a portfolio that does not trade adds 0. Each capital adds up in date order, so it matches
+# settling that portfolio's trades on their own exactly
+def settle_columns(prices, trading, buys, caps, bought, sold):
+    candidates = trading & buys
+    sells = trading & ~buys
+    proceeds = np.where(sells, prices, 0.0)
+    any_buys = candidates.any(axis=1)
+    buy = np.empty(caps.shape, dtype=bool)
+    cost = np.empty(caps.shape)
+    for date in np.flatnonzero(trading.any(axis=1)):
+        if any_buys[date]:
+            price = prices[date]
+            np.greater_equal(caps, price, out=buy)
+            buy &= candidates[date]
+            np.multiply(price, buy, out=cost)
+            caps -= cost
+            bought += buy
+        caps += proceeds[date]
+    sold += sells.sum(axis=0)
+
+
+# Final capital and number of trades for each (over_spread, under_spread) pair with one short window. The spread is
+# worked out once per chunk of dates and every pair's signals and trades from it at once, as panel_backtest does
+# for tickers. Stocks still held at the end are sold at the last price
+def evaluate_spreads(prices, prefix, short_time, spreads, cap, stock_number, start=10, chunk=256):
+    over_spread, under_spread = np.asarray(spreads, dtype=float).reshape(-1, 2).T
+    caps = np.full(len(over_spread), float(cap))
+    bought = np.zeros(len(caps), dtype=np.int64)
+    sold = np.zeros(len(caps), dtype=np.int64)
+    trades = np.zeros(len(caps), dtype=np.int64)
+    for first in range(start, len(prices), chunk):
+        last = min(first + chunk, len(prices))
+        spread = moving_average_spread(prefix, short_time, first, last)[:, None]
+        trading = (spread >= under_spread) | (spread <= -over_spread)
+        trades += trading.sum(axis=0)
+        settle_columns(prices[first:last, None], trading, spread > 0, caps, bought, sold)
+    stocks = stock_number + bought - sold
+    final_cap = np.where(stocks > 0, caps + stocks * float(prices[-1]), caps)
+    return list(zip(final_cap.tolist(), trades.tolist()))
+
+
+# Each sweep worker process keeps the prices and their prefix sums here
+sweep_prices = None
+sweep_prefix = None
+
+
+def attach_sweep(prices, prefix):
+    global sweep_prices, sweep_prefix
+    sweep_prices, sweep_prefix = prices, prefix
+
+
+def sweep_worker(task):
+    return evaluate_spreads(sweep_prices, sweep_prefix, *task)
+
+
+# Backtests every (short_time, over_spread, under_spread) parameter set on the prices and returns a table ranked by
+# final capital. The prefix sums are computed once, the parameter sets are grouped by short window so each window's
+# averages are computed once, and batches of up to batch_size sets are spread over n_jobs processes (-1 for every
+# core). Every result is the same as running MovingAverageExperiment with those parameters
+def sweep_parameters(prices, parameters, cap=10000, stock_number=0, n_jobs=None, start=10, batch_size=4000):
+    prices = np.asarray(prices, dtype=float)
+    prefix = price_prefix_sums(prices)
+    parameters = [(int(short_time), float(over), float(under)) for short_time, over, under in parameters]
+    windows = {}
+    for i, (short_time, over, under) in enumerate(parameters):
+        if not 0 <= short_time <= start:
+            raise ValueError("Short time must be between 0 and the start date " + str(start))
+        windows.setdefault(short_time, []).append(i)
+    batches = [indices[k:k + batch_size] for indices in windows.values() for k in range(0, len(indices), batch_size)]
+    tasks = [(parameters[batch[0]][0], [parameters[i][1:] for i in batch], cap, stock_number, start)
+             for batch in batches]
+
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    if not n_jobs or n_jobs == 1:
+        results = [evaluate_spreads(prices, prefix, *task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=attach_sweep, initargs=(prices, prefix)) as executor:
+            results = list(executor.map(sweep_worker, tasks))
+
+    final_cap = np.empty(len(parameters))
+    trades = np.empty(len(parameters), dtype=np.int64)
+    for batch, batch_results in zip(batches, results):
+        final_cap[batch] = [result[0] for result in batch_results]
+        trades[batch] = [result[1] for result in batch_results]
+    table = pd.DataFrame(parameters, columns=["short_time", "over_spread", "under_spread"])
+    table["final_cap"] = final_cap
+    table["total_return"] = final_cap / (cap + stock_number * prices[start]) - 1
+    table["trades"] = trades
+    return table.sort_values("final_cap", ascending=False, kind="mergesort").reset_index(drop=True)
+
+
+# Sweeps every combination of the given short windows and spreads
+def grid_sweep(prices, short_times, over_spreads, under_spreads, **options):
+    return sweep_parameters(prices, product(short_times, over_spreads, under_spreads), **options)
+
+
+# Sweeps number parameter sets drawn at random: short windows are whole numbers and spreads are uniform, each
+# within its (low, high) range
+def random_sweep(prices, number, short_times=(1, 10), over_spreads=(0.0, 200.0), under_spreads=(0.0, 200.0),
+                 seed=None, **options):
+    rng = np.random.default_rng(seed)
+    parameters = zip(rng.integers(short_times[0], short_times[1] + 1, number),
+                     rng.uniform(over_spreads[0], over_spreads[1], number),
+                     rng.uniform(under_spreads[0], under_spreads[1], number))
+    return sweep_parameters(prices, parameters, **options)